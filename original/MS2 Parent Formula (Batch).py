@@ -5,7 +5,9 @@ import re
 import csv
 import time
 import importlib.util
+import multiprocessing
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 import numpy as np
@@ -25,6 +27,12 @@ import pandas as pd
 #  9: beam_width
 # 10: min_intensity
 # 11: ppm_model            <-- NEW (optional; default "path_fit")
+# 12: delta_cache_path     <-- optional; solved deltas persist across runs here
+#                              (default output/cache/delta_cache.sqlite, "none" disables)
+# 13: parallel_min_peaks   <-- optional; scans with at least this many kept peaks solve
+#                              their edges on a process pool (default 300, 0 disables;
+#                              needs the fork start method, scans run serially without it)
+# 14: edge_workers         <-- optional; pool size (default: CPU count)
 pickle_path = sys.argv[1]
 elements_path = sys.argv[2]
 delta_solver_path = sys.argv[3]
@@ -38,6 +46,10 @@ min_intensity = float(sys.argv[10])
 ppm_model = (sys.argv[11].strip().lower() if len(sys.argv) > 11 else "path_fit")
 if ppm_model not in ["path_fit", "per_edge", "global_fixed"]:
     ppm_model = "path_fit"  # safety default
+delta_cache_path = (sys.argv[12].strip() if len(sys.argv) > 12 else
+                    os.path.join(os.getcwd(), "output", "cache", "delta_cache.sqlite"))
+parallel_min_peaks = int(sys.argv[13]) if len(sys.argv) > 13 else 300
+edge_workers = int(sys.argv[14]) if len(sys.argv) > 14 else (os.cpu_count() or 1)
 
 # -------------------------------------------------
 # Outputs
@@ -77,18 +89,28 @@ def write_header_if_needed(path, header_cols):
 log("loading delta_solver module: {}".format(delta_solver_path))
 spec = importlib.util.spec_from_file_location("delta_solver", delta_solver_path)
 delta_solver = importlib.util.module_from_spec(spec)
+sys.modules["delta_solver"] = delta_solver  # so plans and results pickle to edge workers
 spec.loader.exec_module(delta_solver)
 
 parse_bounds = delta_solver.parse_bounds
 load_element_masses = delta_solver.load_element_masses
 find_delta_formulas = delta_solver.find_delta_formulas
 # Expected signature:
-#   find_delta_formulas(obs_delta_mz: float, ppm_tolerance: float, element_bounds, element_masses)
-# Expected keys per match: "delta_formula", "ppm_error"
+#   find_delta_formulas(obs_delta_mz: float, ppm_tolerance: float, solver_plan, output="array")
+# Returns a structured array: one int count field per element plus "ppm_error"
 
 element_bounds = parse_bounds(element_bounds_str)
 element_masses = load_element_masses(elements_path)
-log("element bounds and masses loaded")
+solver_plan = delta_solver.SolverPlan(element_bounds, element_masses)
+log("element bounds and masses loaded; solver plan elements = {}".format(solver_plan.elements))
+
+# Shared on-disk cache of solved deltas; answers repeat deltas (H2O, CO2, ...) across
+# scans and runs with the same bounds, masses and ppm
+delta_cache = None
+if delta_cache_path.lower() != "none":
+    os.makedirs(os.path.dirname(os.path.abspath(delta_cache_path)), exist_ok=True)
+    delta_cache = delta_solver.DeltaCache(delta_cache_path)
+    log("delta cache: {}".format(delta_cache_path))
 
 # -------------------------------------------------
 # Helpers
@@ -118,105 +140,190 @@ def parse_charge_polarity(charge_line):
 def ion_type_from_polarity(sign):
     return "[M]+" if sign == "+" else "[M]-"
 
-def parse_formula(formula_str):
-    parts = re.findall(r"([A-Z][a-z]*)(-?\d+)", str(formula_str))
-    return {el: int(cnt) for el, cnt in parts}
-
 def formula_to_str(fdict):
     elems = sorted([e for e, v in fdict.items() if v != 0])
     return "".join("{}{}".format(el, fdict[el]) for el in elems) if elems else ""
 
+# Formulas inside the beam are count tuples in solver_plan.elements order
 def add_formulas(f1, f2):
-    res = defaultdict(int, f1)
-    for el, cnt in f2.items():
-        res[el] += cnt
-    return dict(res)
+    return tuple(a + b for a, b in zip(f1, f2))
 
-def has_negative_counts(fdict):
-    return any(v < 0 for v in fdict.values())
+def has_negative_counts(counts):
+    return any(v < 0 for v in counts)
+
+def counts_to_dict(counts, elements):
+    return {el: v for el, v in zip(elements, counts) if v != 0}
 
 def robust_median(vals):
     if not vals:
         return 0.0
     return float(np.median(np.array(vals, dtype=float)))
 
+# -------------------------------------------------
+# Typed edge graph, built once per scan and walked directly by the beam
+# -------------------------------------------------
+#   mzs           float64 (n,) node m/z, ascending; equal peaks share one node
+#   src, dst      int64 (E,) node of each edge, low -> high (src is the lower m/z)
+#   out_offsets   int64 (n + 1,) edges leaving node i are out_edges[out_offsets[i]:out_offsets[i + 1]]
+#   out_edges     int64 (E,) edge ids grouped by src, in build order within a node
+#   cand_offsets  int64 (E + 1,) candidates of edge e are rows cand_offsets[e]:cand_offsets[e + 1]
+#   compositions  int64 (C, len(elements)) candidate delta compositions
+#   ppm           float64 (C,) candidate ppm errors, rounded to 2 decimals as reported
+class EdgeGraph:
+
+    def __init__(self, mzs, elements, src, dst, cand_offsets, compositions, ppm):
+        self.mzs = mzs
+        self.elements = list(elements)
+        self.src = src
+        self.dst = dst
+        self.cand_offsets = cand_offsets
+        self.compositions = compositions
+        self.ppm = ppm
+        self.out_edges = np.argsort(src, kind="stable")
+        self.out_offsets = np.zeros(len(mzs) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=len(mzs)), out=self.out_offsets[1:])
+
+    def __len__(self):
+        return len(self.src)
+
+    def out(self, node):
+        return self.out_edges[self.out_offsets[node]:self.out_offsets[node + 1]]
+
+    # (count tuple, ppm) pairs of one edge, in solver order
+    def candidates(self, edge):
+        lo, hi = self.cand_offsets[edge], self.cand_offsets[edge + 1]
+        return list(zip(map(tuple, self.compositions[lo:hi].tolist()), self.ppm[lo:hi].tolist()))
+
+# -------------------------------------------------
+# Intra-scan parallel solving for large scans
+# -------------------------------------------------
+# Forked workers inherit the loaded delta_solver and never re-run this script. Spawned
+# ones would re-run its top level (argv, output dirs, debug.txt truncation), so without
+# fork the pool is never started and every scan takes the serial path.
+edge_pool = None
+edge_fork = "fork" in multiprocessing.get_all_start_methods()
+
+def get_edge_pool():
+    global edge_pool
+    if edge_pool is None:
+        edge_pool = ProcessPoolExecutor(max_workers=edge_workers, mp_context=multiprocessing.get_context("fork"))
+    return edge_pool
+
+def solve_pairs_parallel(pair_i, deltas, ppm_tol):
+    # cut the row-major pair list at row starts into ~4 blocks per worker of similar size;
+    # results are gathered in block order, so edges come out exactly as in the serial build
+    row_starts = np.flatnonzero(np.r_[True, np.diff(pair_i) != 0])
+    wanted = np.linspace(0, len(deltas), edge_workers * 4 + 1)[1:-1]
+    cuts = row_starts[np.minimum(np.searchsorted(row_starts, wanted), len(row_starts) - 1)]
+    bounds = np.unique(np.r_[0, cuts, len(deltas)])
+    pool = get_edge_pool()
+    futures = [pool.submit(delta_solver.solve_delta_block, deltas[a:b], ppm_tol, solver_plan, cache=delta_cache)
+               for a, b in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+    results = []
+    for future in futures:
+        block, hits, misses = future.result()
+        results.extend(block)
+        if delta_cache is not None:
+            delta_cache.hits += hits
+            delta_cache.misses += misses
+    return results, len(futures)
+
 # -------------------------------------------------
 # Sequencer-style edge builder (high -> low)
 # -------------------------------------------------
 def build_edges_from_peaks(mzs_desc, max_delta, ppm_tol):
-    rows = []
-    n = len(mzs_desc)
     slow_call_threshold = 1.0  # seconds, logging only
-    for i in range(n):
-        mz1 = mzs_desc[i]
-        for j in range(i + 1, n):
-            mz2 = mzs_desc[j]
-            delta = mz1 - mz2
-            if delta < 0:
-                continue
-            entry = {"Fragment_1": mz1, "Fragment_2": mz2, "Matched": "", "PPM_Errors": ""}
-            if delta <= max_delta:
-                t0 = time.time()
-                matches = find_delta_formulas(delta, ppm_tol, element_bounds, element_masses)
-                dt = time.time() - t0
-                if dt > slow_call_threshold:
-                    log("solver slow: delta={:.10f} took {:.3f}s".format(delta, dt))
-                if matches:
-                    entry["Matched"]    = ", ".join(m["delta_formula"] for m in matches)
-                    entry["PPM_Errors"] = ", ".join(str(m.get("ppm_error", "")) for m in matches)
-                else:
-                    entry["Matched"] = "No match"
-            else:
-                entry["Matched"] = "Delta > threshold"
-            rows.append(entry)
-    df = pd.DataFrame(rows)
-    df = df[df["Matched"].notna() & df["PPM_Errors"].notna()].copy()
-    df = df[~df["Matched"].astype(str).str.contains("Delta > threshold", na=False)].copy()
-    df = df[~df["Matched"].astype(str).str.contains("No match", na=False)].copy()
-    return df
+    mzs = np.asarray(mzs_desc, dtype=float)
+    # peaks are sorted high -> low, so the partners of peak i within max_delta are the
+    # window j in [i + 1, stop[i]); stop comes from a binary search on the ascending view.
+    # Pairs are generated window by window (O(n * w), not n^2) in the old (i, j) loop order,
+    # with a little slack on the window edge and the exact delta test applied afterwards.
+    n = len(mzs)
+    ascending = mzs[::-1]
+    stop = n - np.searchsorted(ascending, mzs - max_delta - 1e-6, side="left")
+    counts = np.maximum(stop - np.arange(1, n + 1), 0)
+    pair_i = np.repeat(np.arange(n), counts)
+    pair_j = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + pair_i + 1
+    deltas = mzs[pair_i] - mzs[pair_j]
+    in_range = (deltas >= 0) & (deltas <= max_delta)
+    pair_i, pair_j, deltas = pair_i[in_range], pair_j[in_range], deltas[in_range]
+
+    # deltas agreeing within ppm_tol (CH2 / H2O ladders) are solved once per cluster
+    solver_calls = []
+    def timed_solve(delta, ppm, plan, **kwargs):
+        t0 = time.time()
+        matches = find_delta_formulas(delta, ppm, plan, **kwargs)
+        dt = time.time() - t0
+        if dt > slow_call_threshold:
+            log("solver slow: delta={:.10f} took {:.3f}s".format(delta, dt))
+        solver_calls.append(dt)
+        return matches
+
+    if edge_fork and parallel_min_peaks > 0 and n >= parallel_min_peaks and edge_workers > 1 and len(deltas):
+        t0 = time.time()
+        results, blocks = solve_pairs_parallel(pair_i, deltas, ppm_tol)
+        log("edges: {} pairs in range solved in {} blocks on {} workers in {:.3f}s".format(
+            len(deltas), blocks, edge_workers, time.time() - t0))
+    else:
+        results = delta_solver.find_delta_formulas_clustered(deltas, ppm_tol, solver_plan, solve=timed_solve,
+                                                             cache=delta_cache)
+        log("edges: {} pairs in range, {} solver calls".format(len(deltas), len(solver_calls)))
+    keep = np.array([k for k, matches in enumerate(results) if len(matches)], dtype=np.int64)
+    matches_list = [results[k] for k in keep.tolist()]
+
+    elements = solver_plan.elements
+    nodes, node_of_peak = np.unique(mzs, return_inverse=True)
+    cand_offsets = np.zeros(len(keep) + 1, dtype=np.int64)
+    np.cumsum([len(m) for m in matches_list], out=cand_offsets[1:])
+    if matches_list:
+        compositions = np.concatenate([np.column_stack([m[e] for e in elements]) for m in matches_list])
+        compositions = compositions.astype(np.int64).reshape(-1, len(elements))
+        ppm = np.array([round(p, 2) for m in matches_list for p in m["ppm_error"].tolist()], dtype=float)
+    else:
+        compositions = np.zeros((0, len(elements)), dtype=np.int64)
+        ppm = np.zeros(0, dtype=float)
+    return EdgeGraph(nodes, elements, node_of_peak[pair_j[keep]].astype(np.int64),
+                     node_of_peak[pair_i[keep]].astype(np.int64), cand_offsets, compositions, ppm)
 
 # -------------------------------------------------
 # Beam inference with coverage (force PEPMASS)
 # HYBRID + SINGLETON seeding in PPM mode
 # -------------------------------------------------
-def beam_infer_parent_with_coverage(edges_df, rel_series, max_start_mz, ppm_tol, beam_width,
+def beam_infer_parent_with_coverage(graph, rel_series, max_start_mz, ppm_tol, beam_width,
                                     parent_mz, ppm_model="path_fit", parent_mz_tol=1e-4):
-    if edges_df.empty:
+    if len(graph) == 0:
         return None, None, {}, {
             "num_edges": 0, "num_paths": 0,
             "ppm_offset": 0.0, "coverage_pct": 0.0
         }
 
-    df = edges_df.copy()
-    df["Formula_list"] = df["Matched"].apply(
-        lambda x: [parse_formula(f.strip()) for f in str(x).split(",") if f.strip() != ""]
-    )
-    df["PPM_list"] = df["PPM_Errors"].apply(
-        lambda x: [float(p.strip()) for p in str(x).split(",") if p.strip() != ""]
-    )
-
-    # reverse edge direction (low -> high)
-    up = pd.DataFrame({
-        "Fragment_1": df["Fragment_2"].astype(float),
-        "Fragment_2": df["Fragment_1"].astype(float),
-        "Formula_list": df["Formula_list"],
-        "PPM_list": df["PPM_list"]
-    })
+    elements = graph.elements
+    node_mzs = graph.mzs.tolist()
+    node_of = {mz: i for i, mz in enumerate(node_mzs)}
+    edge_dst = graph.dst.tolist()
+    edge_candidates = {}
+    def candidates(edge):
+        if edge not in edge_candidates:
+            edge_candidates[edge] = graph.candidates(edge)
+        return edge_candidates[edge]
 
     # Candidate seeds (by source node) no higher than max_start_mz
-    sources = set(up["Fragment_1"].astype(float).tolist())
+    sources = set(node_mzs[s] for s in np.unique(graph.src).tolist())
     seed_frags = sorted([mz for mz in sources if mz <= max_start_mz])
 
     # Base from 0.0 -> seed (singleton median defines GLOBAL offset if used)
     base_map = defaultdict(list)
-    zero_to_seed = up[up["Fragment_1"] == 0.0].copy()
-    for _, row in zero_to_seed.iterrows():
-        dest = float(row["Fragment_2"])
-        for fml, ppm in zip(row["Formula_list"], row["PPM_list"]):
+    zero_node = node_of.get(0.0)
+    for edge in ([] if zero_node is None else graph.out(zero_node).tolist()):
+        dest = node_mzs[edge_dst[edge]]
+        for fml, ppm in candidates(edge):
             base_map[dest].append((fml, ppm))
 
-    def f_key(fd):
-        return formula_to_str(fd)
+    formula_strs = {}
+    def f_key(counts):
+        if counts not in formula_strs:
+            formula_strs[counts] = formula_to_str(counts_to_dict(counts, elements))
+        return formula_strs[counts]
 
     singleton_seeds = []
     for dest, lst in base_map.items():
@@ -248,13 +355,13 @@ def beam_infer_parent_with_coverage(edges_df, rel_series, max_start_mz, ppm_tol,
             })
         else:
             beams[frag].append({
-                "path": [(frag, {}, None)],
+                "path": [(frag, (0,) * len(elements), None)],
                 "errors": []
             })
 
     if not any(beams.values()):
         return None, None, {}, {
-            "num_edges": int(len(up)),
+            "num_edges": int(len(graph)),
             "num_paths": 0,
             "ppm_offset": (global_ppm_offset if ppm_model == "global_fixed" else 0.0),
             "coverage_pct": 0.0,
@@ -294,16 +401,14 @@ def beam_infer_parent_with_coverage(edges_df, rel_series, max_start_mz, ppm_tol,
     while any(beams.values()):
         new_beams = defaultdict(list)
         for node_mz, states in beams.items():
-            outs = up[up["Fragment_1"] == node_mz]
-            if outs.empty:
+            outs = graph.out(node_of[node_mz]).tolist()
+            if not outs:
                 continue
             for state in states:
                 last_frag, last_formula, _ = state["path"][-1]
-                for _, e_row in outs.iterrows():
-                    dest  = float(e_row["Fragment_2"])
-                    flist = e_row["Formula_list"]
-                    plist = e_row["PPM_list"]
-                    for cand_formula, ppm_err in zip(flist, plist):
+                for edge in outs:
+                    dest = node_mzs[edge_dst[edge]]
+                    for cand_formula, ppm_err in candidates(edge):
                         new_formula = add_formulas(last_formula, cand_formula)
                         if has_negative_counts(new_formula):
                             continue
@@ -351,7 +456,7 @@ def beam_infer_parent_with_coverage(edges_df, rel_series, max_start_mz, ppm_tol,
     def path_sig(st): return tuple(x[0] for x in st["path"])
     votes = defaultdict(set)
     for st in final_paths:
-        pf = formula_to_str(st["path"][-1][1])
+        pf = f_key(st["path"][-1][1])
         votes[pf].add(path_sig(st))
 
     def mae_ppm_with(st):
@@ -365,11 +470,11 @@ def beam_infer_parent_with_coverage(edges_df, rel_series, max_start_mz, ppm_tol,
 
     paths_by_formula = defaultdict(list)
     for st in final_paths:
-        paths_by_formula[formula_to_str(st["path"][-1][1])].append(st)
+        paths_by_formula[f_key(st["path"][-1][1])].append(st)
 
     if not paths_by_formula:
         return None, None, {}, {
-            "num_edges": len(up),
+            "num_edges": len(graph),
             "num_paths": 0,
             "ppm_offset": (global_ppm_offset if ppm_model == "global_fixed" else 0.0),
             "coverage_pct": 0.0,
@@ -402,12 +507,13 @@ def beam_infer_parent_with_coverage(edges_df, rel_series, max_start_mz, ppm_tol,
     )
     top_pf = ordered[0]
     winner = best_path_for_formula[top_pf]
+    winner = dict(winner, path=[(mz, counts_to_dict(counts, elements), ppm) for mz, counts, ppm in winner["path"]])
 
     # Report the relevant offset for the winner (for details.tsv)
     winner_eps = path_epsilons.get(top_pf, 0.0) if ppm_model != "global_fixed" else global_ppm_offset
 
     stats = {
-        "num_edges": len(up),
+        "num_edges": len(graph),
         "num_paths": len([1 for _ in final_paths_all]),
         "ppm_offset": float(winner_eps if ppm_model in ["path_fit"] else (global_ppm_offset if ppm_model == "global_fixed" else 0.0)),
         "votes_map": {k: len(v) for k, v in votes.items()},
@@ -494,13 +600,13 @@ def main():
         # edges
         mzs_desc = sorted([mz for mz, _ in rel_peaks], reverse=True)
         log("scan {}: building edges".format(idx))
-        edges_df = build_edges_from_peaks(mzs_desc, max_mz_delta, ppm_tolerance)
-        log("scan {}: edges built = {}".format(idx, len(edges_df)))
+        edge_graph = build_edges_from_peaks(mzs_desc, max_mz_delta, ppm_tolerance)
+        log("scan {}: edges built = {}".format(idx, len(edge_graph)))
 
         # infer (force PEPMASS as parent target)
         log("scan {}: beam infer (forcing parent target {:.4f})".format(idx, float(pepmass) if pepmass is not None else float("nan")))
         top_formula, winner_state, votes_map, stats = beam_infer_parent_with_coverage(
-            edges_df, rel_series, max_start_mz, ppm_tolerance, beam_width,
+            edge_graph, rel_series, max_start_mz, ppm_tolerance, beam_width,
             parent_mz=pepmass, ppm_model=ppm_model, parent_mz_tol=1e-4
         )
 
@@ -574,6 +680,11 @@ def main():
 
         log("scan {}: done".format(idx))
 
+    if edge_pool is not None:
+        edge_pool.shutdown()
+    if delta_cache is not None:
+        delta_cache.close()
+        log("delta cache: {hits} hits, {misses} misses, hit rate {hit_rate:.1%}".format(**delta_cache.stats()))
     log("All scans processed.")
 
 if __name__ == "__main__":
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# Delta solver benchmark
+#
+# Times find_delta_formulas backends over a matrix of element sets, bound widths,
+# ppm tolerances and delta magnitudes, and reports calls/s, peak traced memory and
+# per-delta result-count parity against a reference backend.
+#
+#   python delta_bench.py                      # full matrix, TSV on stdout
+#   python delta_bench.py --quick --out bench.tsv
+#   python delta_bench.py --elements elements.tsv --backends bnb,mitm,index
+import argparse
+import math
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import delta_solver
+
+# Monoisotopic masses and per-element limits from scratch.ipynb
+ELEMENT_MASSES = {"C": 12.0, "H": 1.007825035, "N": 14.003074, "O": 15.99491463, "P": 30.973762,
+                  "S": 31.9720707, "Cl": 34.968853, "Na": 22.98977, "F": 18.998403, "Br": 78.91834}
+ELEMENT_LIMITS = {"C": 50, "H": 80, "N": 10, "O": 8, "P": 1, "S": 1, "Cl": 1, "Na": 1, "Br": 1, "F": 4}
+
+ELEMENT_SETS = {
+    "C": ["C"],
+    "CHNO": ["C", "H", "N", "O"],
+    "CHNOPS": ["C", "H", "N", "O", "P", "S"],
+    "CHNOPSClBrF": ["C", "H", "N", "O", "P", "S", "Cl", "Br", "F"],
+    "all10": ["C", "H", "N", "O", "P", "S", "Cl", "Na", "Br", "F"],
+}
+# Fraction of ELEMENT_LIMITS used for each element (at least one count either way)
+WIDTHS = {"narrow": 0.1, "medium": 0.25, "wide": 0.5}
+PPM_TOLERANCES = [1.0, 5.0, 20.0]
+DELTA_MAGNITUDES = [20.0, 100.0, 300.0]
+
+BACKENDS = ["product", "vectorized", "mitm", "residue", "bnb", "index", "batch"]
+# Largest lattice each backend is run on; the rest have no size limit
+MAX_LATTICE = {"product": 2e5, "vectorized": 5e7, "index": 2e7, "batch": 2e7}
+
+
+def bounds_for(elements, width, signed):
+    bounds = {}
+    for e in elements:
+        span = max(1, int(round(ELEMENT_LIMITS[e] * WIDTHS[width])))
+        bounds[e] = (-span if signed else 0, span)
+    return bounds
+
+
+def lattice_size(bounds):
+    return math.prod(hi - lo + 1 for lo, hi in bounds.values())
+
+
+# Deltas near magnitude: masses of random compositions inside the bounds, jittered
+# within half the tolerance, so most queries have real matches. Falls back to
+# plain random values when the bounds cannot reach the magnitude.
+def sample_deltas(bounds, element_masses, magnitude, ppm, count, rng, tries=20000):
+    deltas = []
+    for _ in range(tries):
+        if len(deltas) == count:
+            break
+        mass = sum(rng.randint(lo, hi) * element_masses[e] for e, (lo, hi) in bounds.items())
+        if 0.8 * magnitude <= abs(mass) <= 1.2 * magnitude:
+            deltas.append(mass * (1 + rng.uniform(-0.5, 0.5) * ppm / 1e6))
+    while len(deltas) < count:
+        deltas.append(magnitude * rng.uniform(0.9, 1.1))
+    return deltas
+
+
+# Per-delta result counts of one backend over every delta
+def solve_all(backend, plan, deltas, ppm):
+    if backend == "batch":
+        offsets, _, _ = delta_solver.find_delta_formulas_batch(np.array(deltas), ppm, plan)
+        return np.diff(offsets).tolist()
+    if backend == "index":
+        index = plan.index()
+        return [len(index.query(d, ppm, output="array")) for d in deltas]
+    return [len(delta_solver.find_delta_formulas(d, ppm, plan, strategy=backend, output="array")) for d in deltas]
+
+
+# Run one backend over every delta; returns (seconds, peak bytes, per-delta counts).
+# tracemalloc slows Python-heavy backends by up to 10x, so the timed pass runs
+# untraced and peak memory comes from a second, traced pass.
+def run_backend(backend, plan, deltas, ppm):
+    t0 = time.perf_counter()
+    counts = solve_all(backend, plan, deltas, ppm)
+    elapsed = time.perf_counter() - t0
+    tracemalloc.start()
+    solve_all(backend, plan, deltas, ppm)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, counts
+
+
+def runnable(backend, bounds, signed):
+    if backend == "residue" and signed:
+        return False
+    return lattice_size(bounds) <= MAX_LATTICE.get(backend, math.inf)
+
+
+def benchmark(element_masses, element_sets, widths, ppms, magnitudes, backends, deltas_per_cell, seed):
+    rows = []
+    for set_name, elements in element_sets.items():
+        elements = [e for e in elements if e in element_masses]
+        for width in widths:
+            for signed in (True, False):
+                bounds = bounds_for(elements, width, signed)
+                plan = delta_solver.SolverPlan(bounds, element_masses)
+                active = [b for b in backends if runnable(b, bounds, signed)]
+
+                # index build is timed once per bounds set and reported separately
+                index_build = float("nan")
+                if "index" in active or "batch" in active:
+                    t0 = time.perf_counter()
+                    plan.index()
+                    index_build = time.perf_counter() - t0
+
+                for ppm in ppms:
+                    for magnitude in magnitudes:
+                        rng = random.Random(seed)
+                        deltas = sample_deltas(bounds, element_masses, magnitude, ppm, deltas_per_cell, rng)
+                        reference = None
+                        for backend in active:
+                            elapsed, peak, counts = run_backend(backend, plan, deltas, ppm)
+                            if reference is None:
+                                reference = (backend, counts)
+                            mismatches = sum(a != b for a, b in zip(counts, reference[1]))
+                            rows.append({
+                                "element_set": set_name,
+                                "width": width,
+                                "signed": signed,
+                                "lattice": lattice_size(bounds),
+                                "ppm": ppm,
+                                "delta": magnitude,
+                                "backend": backend,
+                                "calls_per_s": len(deltas) / elapsed if elapsed > 0 else float("inf"),
+                                "peak_mb": peak / 2 ** 20,
+                                "index_build_s": index_build if backend in ("index", "batch") else float("nan"),
+                                "results": sum(counts),
+                                "parity": "ok" if mismatches == 0 else "MISMATCH {} vs {}".format(
+                                    mismatches, reference[0]),
+                            })
+                            print("{element_set}\t{width}\t{signed}\t{ppm}\t{delta}\t{backend}\t"
+                                  "{calls_per_s:.1f} calls/s\t{parity}".format(**rows[-1]), file=sys.stderr)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark delta solver backends")
+    parser.add_argument("--elements", help="elements TSV (Symbol, mz); defaults to the notebook masses")
+    parser.add_argument("--sets", default=",".join(ELEMENT_SETS), help="element sets to run")
+    parser.add_argument("--widths", default=",".join(WIDTHS), help="bound widths to run")
+    parser.add_argument("--ppm", default=",".join(str(p) for p in PPM_TOLERANCES))
+    parser.add_argument("--deltas", default=",".join(str(d) for d in DELTA_MAGNITUDES))
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--per-cell", type=int, default=20, help="deltas timed per matrix cell")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--quick", action="store_true", help="C/CHNO/CHNOPS, narrow bounds, 5 deltas per cell")
+    parser.add_argument("--out", help="write the result table as TSV instead of stdout")
+    args = parser.parse_args(argv)
+
+    element_masses = delta_solver.load_element_masses(args.elements) if args.elements else ELEMENT_MASSES
+    sets = args.sets.split(",")
+    widths = args.widths.split(",")
+    per_cell = args.per_cell
+    if args.quick:
+        sets, widths, per_cell = ["C", "CHNO", "CHNOPS"], ["narrow"], 5
+
+    rows = benchmark(element_masses, {s: ELEMENT_SETS[s] for s in sets}, widths,
+                     [float(p) for p in args.ppm.split(",")], [float(d) for d in args.deltas.split(",")],
+                     args.backends.split(","), per_cell, args.seed)
+
+    columns = list(rows[0]) if rows else []
+    out = open(args.out, "w") if args.out else sys.stdout
+    out.write("\t".join(columns) + "\n")
+    for row in rows:
+        out.write("\t".join(
+            "{:.4g}".format(row[c]) if isinstance(row[c], float) else str(row[c]) for c in columns) + "\n")
+    if args.out:
+        out.close()
+    return 1 if any(row["parity"] != "ok" for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,23 @@
 import pandas as pd
+import numpy as np
 import itertools
+import functools
+import hashlib
+import json
+import logging
+import math
+import os
 import re
+import sqlite3
+import struct
+import time
+import zlib
 
 SCALE = 10000  # Integer scaling factor for mass precision
+CHUNK_SIZE = 1 << 20  # Compositions evaluated per block by the vectorized engine
+PACK_BLOCK_ROWS = 1024  # Composition rows per compressed block in packed storage
+
+logger = logging.getLogger(__name__)
 
 # Parse user-supplied element bounds (e.g. "C[-5,5], H[-10,10]")
 def parse_bounds(bounds_str):
@@ -18,17 +33,253 @@ def load_element_masses(path):
     df = pd.read_csv(path, sep="\t")
     return dict(zip(df["Symbol"], df["mz"]))
 
-# Core search function to find formulas matching a delta mass
-def find_delta_formulas(delta_mass, ppm_tolerance, element_bounds, element_masses):
+# Element order, integer masses and coefficient bounds shared by every engine.
+# element_bounds may also be a SolverPlan, in which case element_masses is unused.
+def _prepare(element_bounds, element_masses):
+    if isinstance(element_bounds, SolverPlan):
+        plan = element_bounds
+        return plan.elements, plan.mass_i, plan.lows, plan.highs
+    elements = [e for e in element_bounds if e in element_masses]
+    mass_i = np.array([int(round(element_masses[e] * SCALE)) for e in elements], dtype=np.int64)
+    lows = np.array([element_bounds[e][0] for e in elements], dtype=np.int64)
+    highs = np.array([element_bounds[e][1] for e in elements], dtype=np.int64)
+    return elements, mass_i, lows, highs
+
+# Solver setup compiled once from the bounds string and elements TSV: element order,
+# integer masses, bound arrays and the heaviest-first visiting order. Plain lists
+# and small arrays only, so it pickles cheaply to joblib/multiprocessing workers.
+# Every solver entry point accepts a plan in place of element_bounds.
+class SolverPlan:
+
+    def __init__(self, element_bounds, element_masses, index_path=None):
+        elements = [e for e in element_bounds if e in element_masses]
+        self.element_bounds = {e: (int(element_bounds[e][0]), int(element_bounds[e][1])) for e in elements}
+        self.element_masses = {e: float(element_masses[e]) for e in elements}
+        self.elements, self.mass_i, self.lows, self.highs = _prepare(self.element_bounds, self.element_masses)
+        self.order = np.argsort(-self.mass_i, kind="stable")
+        self.index_path = index_path
+        self._index = None
+
+    @classmethod
+    def from_files(cls, bounds_str, elements_path):
+        return cls(parse_bounds(bounds_str), load_element_masses(elements_path))
+
+    # Hashable identity of the plan (elements, bounds, masses, scale)
+    def key(self):
+        return (tuple((e, self.element_bounds[e], self.element_masses[e]) for e in self.elements), SCALE)
+
+    # Same fields as DeltaIndex.describe, used to check a saved index fits the plan
+    def describe(self):
+        return {
+            "elements": self.elements,
+            "bounds": {e: list(self.element_bounds[e]) for e in self.elements},
+            "element_masses": self.element_masses,
+            "scale": SCALE,
+        }
+
+    # DeltaIndex over the plan's bounds, kept for later calls. With an index_path the
+    # saved file is memory-mapped; otherwise the index is built on first use.
+    def index(self):
+        if self._index is None:
+            if self.index_path is not None and os.path.exists(self.index_path):
+                self._index = DeltaIndex.load(self.index_path, plan=self)
+            else:
+                self._index = DeltaIndex(self)
+        return self._index
+
+    # Build (if needed) and save the index so workers receiving this plan map the file
+    def save_index(self, path, packed=False):
+        self.index().save(path, packed=packed)
+        self.index_path = path
+
+    # The index is reloaded (memory-mapped) or rebuilt on demand rather than shipped to workers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_index"] = None
+        return state
+
+# Dict form of the bounds and masses for engines that work on dicts
+def _plan_dicts(element_bounds, element_masses):
+    if isinstance(element_bounds, SolverPlan):
+        return element_bounds.element_bounds, element_bounds.element_masses
+    return element_bounds, element_masses
+
+# Yield coefficient blocks of the bounds lattice in itertools.product order.
+# Row k of the lattice is decoded from its flat index with mixed-radix arithmetic,
+# so only chunk_size rows are ever held in memory at once.
+def iter_lattice_chunks(lows, highs, chunk_size=CHUNK_SIZE):
+    sizes = [int(h) - int(l) + 1 for l, h in zip(lows, highs)]
+    if any(s <= 0 for s in sizes):
+        return
+    total = math.prod(sizes)
+    for start in range(0, total, chunk_size):
+        idx = np.arange(start, min(start + chunk_size, total), dtype=np.int64)
+        coeffs = np.empty((len(idx), len(sizes)), dtype=np.int64)
+        for k in reversed(range(len(sizes))):
+            idx, digit = np.divmod(idx, sizes[k])
+            coeffs[:, k] = digit + lows[k]
+        yield coeffs
+
+# Build one output record; shared so every engine returns identical dicts
+def _format_record(coeffs, elements, delta_mass, ppm_error):
+    coeff_dict = {e: coeffs[i] for i, e in enumerate(elements)}
+    delta_formula = "".join([f"{e}{v:+d}".replace("+", "") for e, v in coeff_dict.items() if v != 0])
+
+    result = {
+        "ppm_error": round(ppm_error, 2),
+        "delta_mass": round(delta_mass, 6),
+        "delta_formula": delta_formula
+    }
+    for e in elements:
+        result[e] = coeff_dict[e]
+    return result
+
+# Structured dtype of array results: one int16 count field per element followed by
+# the unrounded ppm_error and delta_mass
+def result_dtype(elements):
+    return np.dtype([(e, np.int16) for e in elements] + [("ppm_error", np.float64), ("delta_mass", np.float64)])
+
+def empty_result(elements):
+    return np.zeros(0, dtype=result_dtype(elements))
+
+def result_elements(results):
+    return list(results.dtype.names[:-2])
+
+# Pack already filtered and ordered composition rows into an array result
+def _pack_result(coeffs, totals, target_mass_i, elements):
+    results = np.zeros(len(coeffs), dtype=result_dtype(elements))
+    for i, e in enumerate(elements):
+        results[e] = coeffs[:, i]
+    deltas = totals - target_mass_i
+    results["ppm_error"] = deltas / target_mass_i * 1e6
+    results["delta_mass"] = deltas / SCALE
+    return results
+
+# Formula strings (the "delta_formula" text) of an array result; only needed for output
+def format_delta_formulas(results):
+    elements = result_elements(results)
+    rows = results[elements].tolist()
+    return ["".join(f"{e}{v}" for e, v in zip(elements, row) if v != 0) for row in rows]
+
+# Nonzero element counts of each row of an array result, e.g. {"C": 1, "H": -2}
+def composition_dicts(results):
+    elements = result_elements(results)
+    return [{e: v for e, v in zip(elements, row) if v != 0} for row in results[elements].tolist()]
+
+# List-of-dict records for an array result, identical to output="records"
+def to_records(results):
+    elements = result_elements(results)
+    return [_format_record(row[:-2], elements, row[-1], row[-2]) for row in results.tolist()]
+
+# Engines return array results; this adds the output= switch between the compact
+# structured array and the list-of-dict records the batch script historically used
+def _engine(func):
+    @functools.wraps(func)
+    def run(*args, output="records", **kwargs):
+        if output not in ("records", "array"):
+            raise ValueError(f"unknown output {output!r}; expected 'records' or 'array'")
+        results = func(*args, **kwargs)
+        return to_records(results) if output == "records" else results
+    return run
+
+# Typical valences used by the chemistry rules
+VALENCES = {"H": 1, "B": 3, "C": 4, "N": 3, "O": 2, "F": 1, "Na": 1, "Si": 4, "P": 3, "S": 2,
+            "Cl": 1, "K": 1, "Se": 2, "Br": 1, "I": 1}
+
+# Optional valence-based filters applied while compositions are enumerated.
+#   rdbe:    (min, max) ring-plus-double-bond equivalents, 1 + sum(n_i * (v_i - 2)) / 2
+#   parity:  required parity (0 or 1) of the count of odd-valence atoms, i.e. the
+#            nitrogen rule as in the `mults @ composition % 2` notebook experiment
+#   ratios:  {(numerator, denominator): (min, max)}, e.g. {("H", "C"): (0.2, 3.1)},
+#            enforced as min * denominator <= numerator <= max * denominator
+#   senior:  Senior's rules: even valence sum, valence sum >= 2 * largest valence
+#            and valence sum >= 2 * (atoms - 1)
+class FormulaRules:
+
+    def __init__(self, rdbe=None, parity=None, ratios=None, senior=False, valences=None):
+        self.rdbe = rdbe
+        self.parity = parity
+        self.ratios = dict(ratios or {})
+        self.senior = senior
+        self.valences = dict(VALENCES, **(valences or {}))
+
+    # JSON-able settings; identifies the rules in cache keys
+    def describe(self):
+        return {
+            "rdbe": self.rdbe and list(self.rdbe),
+            "parity": self.parity,
+            "ratios": sorted([num, den, low, high] for (num, den), (low, high) in self.ratios.items()),
+            "senior": self.senior,
+            "valences": self.valences,
+        }
+
+    def _valence_vector(self, elements):
+        missing = [e for e in elements if e not in self.valences]
+        if missing:
+            raise ValueError(f"no valence known for {missing}; pass valences={{...}}")
+        return np.array([self.valences[e] for e in elements], dtype=np.int64)
+
+    # Linear constraints lo <= weights @ counts <= hi plus the odd-valence indicator
+    def compile(self, elements):
+        constraints = []
+        odd = np.zeros(len(elements), dtype=np.int64)
+        if self.rdbe is None and self.parity is None and not self.ratios and not self.senior:
+            return constraints, odd
+
+        valences = self._valence_vector(elements)
+        odd = valences % 2
+        unsaturation = valences - 2  # 2 * rdbe - 2 = unsaturation @ counts
+        if self.rdbe is not None:
+            constraints.append((unsaturation, 2 * self.rdbe[0] - 2, 2 * self.rdbe[1] - 2))
+        if self.senior:
+            constraints.append((unsaturation, -2, math.inf))
+        for (num, den), (low, high) in self.ratios.items():
+            if num not in elements or den not in elements:
+                continue
+            upper = np.zeros(len(elements))
+            upper[elements.index(num)] = 1
+            upper[elements.index(den)] = -high
+            lower = np.zeros(len(elements))
+            lower[elements.index(num)] = 1
+            lower[elements.index(den)] = -low
+            constraints.append((upper, -math.inf, 0))
+            constraints.append((lower, 0, math.inf))
+        return constraints, odd
+
+    # Boolean mask of the composition rows (columns in `elements` order) that pass every rule
+    def mask(self, coeffs, elements):
+        keep = np.ones(len(coeffs), dtype=bool)
+        constraints, odd = self.compile(elements)
+        for weights, low, high in constraints:
+            values = coeffs @ weights
+            keep &= (values >= low - 1e-9) & (values <= high + 1e-9)
+        if self.parity is not None:
+            keep &= (coeffs @ odd) % 2 == self.parity
+        if self.senior:
+            keep &= self._senior_mask(coeffs, elements)
+        return keep
+
+    # The non-linear part of Senior's rules: even valence sum and sum >= 2 * largest valence
+    def _senior_mask(self, coeffs, elements):
+        valences = self._valence_vector(elements)
+        total = coeffs @ valences
+        largest = np.where(coeffs > 0, valences, 0).max(axis=1) if len(elements) else np.zeros(len(coeffs))
+        return (total % 2 == 0) & (total >= 2 * largest)
+
+# Reference engine: walk every coefficient tuple in pure Python
+@_engine
+def find_delta_formulas_product(delta_mass, ppm_tolerance, element_bounds, element_masses=None, rules=None):
     target_mass_i = int(round(delta_mass * SCALE))
     ppm_window = int(round(delta_mass * ppm_tolerance * SCALE / 1e6))
-    
+    element_bounds, element_masses = _plan_dicts(element_bounds, element_masses)
+
     elements = [e for e in element_bounds if e in element_masses]
     mass_table = {e: int(round(element_masses[e] * SCALE)) for e in elements}
     bound_table = {e: element_bounds[e] for e in elements}
 
     element_ranges = [range(bound_table[e][0], bound_table[e][1] + 1) for e in elements]
-    results = []
+    kept = []
+    totals = []
 
     for coeffs in itertools.product(*element_ranges):
         if all(c == 0 for c in coeffs):
@@ -39,17 +290,889 @@ def find_delta_formulas(delta_mass, ppm_tolerance, element_bounds, element_masse
         ppm_error = (delta / target_mass_i) * 1e6
 
         if abs(ppm_error) <= ppm_tolerance:
-            coeff_dict = {e: coeffs[i] for i, e in enumerate(elements)}
-            delta_formula = "".join([f"{e}{v:+d}".replace("+", "") for e, v in coeff_dict.items() if v != 0])
-            
-            result = {
-                "ppm_error": round(ppm_error, 2),
-                "delta_mass": round(delta / SCALE, 6),
-                "delta_formula": delta_formula
+            if rules is not None and not rules.mask(np.array([coeffs]), elements)[0]:
+                continue
+            kept.append(coeffs)
+            totals.append(total_mass)
+
+    coeffs = np.array(kept, dtype=np.int64).reshape(len(kept), len(elements))
+    return _pack_result(coeffs, np.array(totals, dtype=np.int64), target_mass_i, elements)
+
+# Smallest signed integer dtype able to hold every coefficient in the bounds
+def _coeff_dtype(lows, highs):
+    lo = int(min(lows, default=0))
+    hi = int(max(highs, default=0))
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return dtype
+    return np.int64
+
+# Integer search bounds guaranteed to contain every mass within ppm_tolerance of target_mass_i
+def _ppm_bounds(target_mass_i, ppm_tolerance):
+    slack = int(abs(target_mass_i) * ppm_tolerance / 1e6) + 1
+    return target_mass_i - slack, target_mass_i + slack
+
+# Apply the exact ppm test (and any rules) to candidate rows and pack the survivors
+# in itertools.product order
+def _select_candidates(coeffs, totals, target_mass_i, ppm_tolerance, elements, rules=None):
+    ppm_errors = (totals - target_mass_i) / target_mass_i * 1e6
+    keep = np.abs(ppm_errors) <= ppm_tolerance
+    if rules is not None:
+        keep &= rules.mask(coeffs, elements)
+    coeffs = coeffs[keep]
+    totals = totals[keep]
+    if len(coeffs) > 1:
+        order = np.lexsort(coeffs.T[::-1])
+        coeffs = coeffs[order]
+        totals = totals[order]
+    return _pack_result(coeffs, totals, target_mass_i, elements)
+
+# Vectorized variant of find_delta_formulas: the lattice is generated in chunks,
+# masses come from one matrix product per chunk and the ppm test runs in bulk.
+# Records (and their order) match find_delta_formulas exactly.
+@_engine
+def find_delta_formulas_vectorized(delta_mass, ppm_tolerance, element_bounds, element_masses=None, rules=None,
+                                   chunk_size=CHUNK_SIZE):
+    target_mass_i = int(round(delta_mass * SCALE))
+    elements, mass_i, lows, highs = _prepare(element_bounds, element_masses)
+    results = [empty_result(elements)]
+
+    for coeffs in iter_lattice_chunks(lows, highs, chunk_size):
+        coeffs = coeffs[np.any(coeffs != 0, axis=1)]  # Skip empty formula
+        results.append(_select_candidates(coeffs, coeffs @ mass_i, target_mass_i, ppm_tolerance, elements, rules))
+
+    return np.concatenate(results)
+
+# Every composition inside a fixed set of bounds, sorted by integer mass and stored
+# CSR-style: unique integer masses (keys), offsets into one composition matrix, so
+# the compositions of keys[i] are rows offsets[i]:offsets[i + 1]. Build once per
+# batch run; each query is then a binary search for the ppm window. The arrays can
+# be saved to one binary file and memory-mapped back (see save / load).
+class DeltaIndex:
+
+    def __init__(self, element_bounds, element_masses=None, chunk_size=CHUNK_SIZE):
+        self.elements, self.mass_i, self.lows, self.highs = _prepare(element_bounds, element_masses)
+        masses = _plan_dicts(element_bounds, element_masses)[1]
+        self.element_masses = {e: float(masses[e]) for e in self.elements}
+        dtype = _coeff_dtype(self.lows, self.highs)
+
+        mass_blocks = []
+        coeff_blocks = []
+        for coeffs in iter_lattice_chunks(self.lows, self.highs, chunk_size):
+            coeffs = coeffs[np.any(coeffs != 0, axis=1)]  # Skip empty formula
+            mass_blocks.append(coeffs @ self.mass_i)
+            coeff_blocks.append(coeffs.astype(dtype))
+
+        masses = np.concatenate(mass_blocks) if mass_blocks else np.zeros(0, dtype=np.int64)
+        coeffs = np.concatenate(coeff_blocks) if coeff_blocks else np.zeros((0, len(self.elements)), dtype=dtype)
+        order = np.argsort(masses, kind="stable")
+        self.keys, counts = np.unique(masses[order], return_counts=True)
+        self.offsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.compositions = coeffs[order]
+
+    def __len__(self):
+        return len(self.compositions)
+
+    # Key range [start, stop) of integer masses in [lo_i, hi_i]
+    def window(self, lo_i, hi_i):
+        start = int(np.searchsorted(self.keys, lo_i, side="left"))
+        stop = int(np.searchsorted(self.keys, hi_i, side="right"))
+        return start, stop
+
+    # Composition rows and their integer masses for the key range [start, stop)
+    def rows(self, start, stop):
+        first, last = int(self.offsets[start]), int(self.offsets[stop])
+        masses = np.repeat(self.keys[start:stop], np.diff(self.offsets[start:stop + 1]))
+        return self.compositions[first:last], masses
+
+    # Same result as find_delta_formulas for the bounds and masses the index was built with
+    def query(self, delta_mass, ppm_tolerance, rules=None, output="records"):
+        target_mass_i = int(round(delta_mass * SCALE))
+        coeffs, masses = self.rows(*self.window(*_ppm_bounds(target_mass_i, ppm_tolerance)))
+        results = _select_candidates(coeffs.astype(np.int64), masses, target_mass_i, ppm_tolerance,
+                                     self.elements, rules)
+        return to_records(results) if output == "records" else results
+
+    # Solve many deltas in one vectorized pass. Deltas are sorted and merged against
+    # the sorted mass keys, and the matches come back CSR-style:
+    #   offsets       int64 (len(deltas) + 1,), matches of delta i are rows offsets[i]:offsets[i + 1]
+    #   compositions  (n_matches, n_elements) counts in self.elements order
+    #   ppm_errors    float64 (n_matches,), unrounded
+    # Rows for each delta are in the same order find_delta_formulas returns them.
+    def query_many(self, deltas, ppm_tolerance, rules=None):
+        targets = np.rint(np.asarray(deltas, dtype=np.float64) * SCALE).astype(np.int64)
+        slack = (np.abs(targets) * ppm_tolerance / 1e6).astype(np.int64) + 1
+        return self._match_many(self.keys, self.offsets, self.compositions, targets, slack, ppm_tolerance, rules)
+
+    # CSR matches of every target against sorted keys/offsets/compositions
+    def _match_many(self, keys, offsets, compositions, targets, slack, ppm_tolerance, rules):
+        by_target = np.argsort(targets, kind="stable")
+        starts = np.empty(len(targets), dtype=np.int64)
+        stops = np.empty(len(targets), dtype=np.int64)
+        starts[by_target] = offsets[np.searchsorted(keys, (targets - slack)[by_target], side="left")]
+        stops[by_target] = offsets[np.searchsorted(keys, (targets + slack)[by_target], side="right")]
+
+        counts = stops - starts
+        owner = np.repeat(np.arange(len(targets)), counts)
+        rows = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+
+        owner_targets = targets[owner]
+        row_masses = keys[np.searchsorted(offsets, rows, side="right") - 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ppm_errors = (row_masses - owner_targets) / owner_targets * 1e6
+        keep = np.abs(ppm_errors) <= ppm_tolerance
+        compositions = compositions[rows]
+        if rules is not None:
+            keep &= rules.mask(compositions.astype(np.int64), self.elements)
+        owner = owner[keep]
+        compositions = compositions[keep]
+        ppm_errors = ppm_errors[keep]
+
+        order = np.lexsort(tuple(compositions.T[::-1]) + (owner,))
+        offsets = np.zeros(len(targets) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(owner, minlength=len(targets)), out=offsets[1:])
+        return offsets, compositions[order], ppm_errors[order]
+
+    # Header fields that identify what the index was built from
+    def describe(self):
+        return {
+            "elements": self.elements,
+            "bounds": {e: [int(lo), int(hi)] for e, lo, hi in zip(self.elements, self.lows, self.highs)},
+            "element_masses": self.element_masses,
+            "scale": SCALE,
+        }
+
+    # Write the index as one binary file:
+    #   magic (8 bytes) | version, header length (little-endian uint32) | JSON header |
+    #   keys, offsets, compositions as raw little-endian arrays, each 64-byte aligned
+    # The header records element order, bounds, masses, scale, array layout and a
+    # CRC32 of the array bytes.
+    # packed=True writes version 2 instead: the rows go through CompositionPacker in
+    # blocks of block_rows, stored as block_first/block_last masses, block_offsets into
+    # the compressed payload, and the payload itself. Loading it gives a PackedDeltaIndex.
+    def save(self, path, packed=False, block_rows=PACK_BLOCK_ROWS):
+        extra = {}
+        if packed:
+            packer = CompositionPacker(self.lows, self.highs)
+            masses = np.repeat(self.keys, np.diff(self.offsets))
+            blocks = list(packer.iter_blocks(masses, self.compositions, block_rows))
+            arrays = {
+                "block_first": np.array([b[0] for b in blocks], dtype="<i8"),
+                "block_last": np.array([b[1] for b in blocks], dtype="<i8"),
+                "block_offsets": np.cumsum([0] + [len(b[3]) for b in blocks]).astype("<i8"),
+                "payload": np.frombuffer(b"".join(b[3] for b in blocks), dtype=np.uint8),
             }
-            for e in elements:
-                result[e] = coeff_dict[e]
+            extra = {"rows": len(self), "block_rows": block_rows}
+        else:
+            arrays = {
+                "keys": self.keys.astype("<i8"),
+                "offsets": self.offsets.astype("<i8"),
+                "compositions": np.ascontiguousarray(self.compositions,
+                                                     dtype=self.compositions.dtype.newbyteorder("<")),
+            }
+        layout = {}
+        checksum = 0
+        position = 0
+        for name, array in arrays.items():
+            position = _aligned(position)
+            layout[name] = {"offset": position, "dtype": array.dtype.str, "shape": list(array.shape)}
+            position += array.nbytes
+            checksum = zlib.crc32(memoryview(array).cast("B"), checksum) if array.nbytes else checksum
+
+        header = dict(self.describe(), arrays=layout, checksum=checksum, **extra)
+        header_bytes = json.dumps(header).encode()
+        version = PACKED_INDEX_VERSION if packed else INDEX_VERSION
+        with open(path + ".tmp", "wb") as handle:
+            handle.write(INDEX_MAGIC + struct.pack("<II", version, len(header_bytes)) + header_bytes)
+            data_start = _aligned(handle.tell())
+            for name, array in arrays.items():
+                handle.write(b"\0" * (data_start + layout[name]["offset"] - handle.tell()))
+                array.tofile(handle)
+        os.replace(path + ".tmp", path)
+
+    # Open a saved index with np.memmap: nothing is copied, so every worker process
+    # that loads the same file shares one set of page-cache pages. verify=True checks
+    # the CRC32 (reads every page once); plan=... checks the index matches a SolverPlan.
+    @classmethod
+    def load(cls, path, verify=False, plan=None):
+        header, data_start = _read_index_header(path)
+        index_cls = PackedDeltaIndex if header["version"] == PACKED_INDEX_VERSION else DeltaIndex
+        index = index_cls.__new__(index_cls)
+        index.elements = header["elements"]
+        index.element_masses = header["element_masses"]
+        index.lows = np.array([header["bounds"][e][0] for e in index.elements], dtype=np.int64)
+        index.highs = np.array([header["bounds"][e][1] for e in index.elements], dtype=np.int64)
+        index.mass_i = np.array([int(round(index.element_masses[e] * header["scale"])) for e in index.elements],
+                                dtype=np.int64)
+
+        checksum = 0
+        for name, spec in header["arrays"].items():
+            shape = tuple(spec["shape"])
+            if math.prod(shape) == 0:
+                array = np.zeros(shape, dtype=spec["dtype"])
+            else:
+                array = np.memmap(path, dtype=spec["dtype"], mode="r", offset=data_start + spec["offset"], shape=shape)
+                if verify:
+                    checksum = zlib.crc32(memoryview(array).cast("B"), checksum)
+            setattr(index, name, array)
+
+        if header["scale"] != SCALE:
+            raise ValueError(f"{path}: built with scale {header['scale']}, solver uses {SCALE}")
+        if verify and checksum != header["checksum"]:
+            raise ValueError(f"{path}: checksum mismatch, file is corrupt or truncated")
+        if plan is not None and plan.describe() != index.describe():
+            raise ValueError(f"{path}: index does not match the solver plan")
+        if isinstance(index, PackedDeltaIndex):
+            index.size = header["rows"]
+            index.packer = CompositionPacker(index.lows, index.highs)
+            index.cache_blocks = 256
+            index._cache = {}
+        return index
+
+INDEX_MAGIC = b"MS2CIDX\0"
+INDEX_VERSION = 1
+PACKED_INDEX_VERSION = 2
+
+def _aligned(position, alignment=64):
+    return -(-position // alignment) * alignment
+
+def _read_index_header(path):
+    with open(path, "rb") as handle:
+        prefix = handle.read(len(INDEX_MAGIC) + 8)
+        if prefix[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError(f"{path}: not a composition index file")
+        version, header_length = struct.unpack("<II", prefix[len(INDEX_MAGIC):])
+        if version not in (INDEX_VERSION, PACKED_INDEX_VERSION):
+            raise ValueError(f"{path}: unsupported index version {version}")
+        header = json.loads(handle.read(header_length))
+    return dict(header, version=version), _aligned(len(prefix) + header_length)
 
-            results.append(result)
+# Compressed storage of mass-sorted composition rows. Each element count is stored as
+# count - low in the fewest bits its bounds need, and the elements are packed side
+# by side into as few unsigned words as fit; masses are delta-encoded against the
+# previous row. Rows are cut into blocks that are zlib-compressed on their own, so
+# any block decodes without touching the rest.
+#   block = zlib(rows uint32 | first mass int64 | step width uint8 | mass steps | words...)
+class CompositionPacker:
 
+    def __init__(self, lows, highs):
+        self.lows = np.asarray(lows, dtype=np.int64)
+        self.highs = np.asarray(highs, dtype=np.int64)
+        self.widths = [int(hi - lo).bit_length() for lo, hi in zip(self.lows, self.highs)]
+        self.words = []  # per word: (column, bit shift) of each element stored in it
+        used = 64
+        for k, width in enumerate(self.widths):
+            if not self.words or used + width > 64:
+                self.words.append([])
+                used = 0
+            self.words[-1].append((k, used))
+            used += width
+        self.word_dtypes = [_uint_dtype(sum(self.widths[k] for k, _ in word)) for word in self.words]
+
+    # Bits per row before compression, for reporting
+    def row_bits(self):
+        return sum(np.dtype(dtype).itemsize * 8 for dtype in self.word_dtypes)
+
+    def encode(self, masses, coeffs):
+        masses = np.asarray(masses, dtype=np.int64)
+        steps = np.diff(masses)
+        step_dtype = _uint_dtype(int(steps.max()).bit_length() if len(steps) else 0)
+        shifted = (np.asarray(coeffs, dtype=np.int64) - self.lows).astype(np.uint64)
+        parts = [struct.pack("<IqB", len(masses), int(masses[0]) if len(masses) else 0, np.dtype(step_dtype).itemsize),
+                 steps.astype(step_dtype).tobytes()]
+        for word, dtype in zip(self.words, self.word_dtypes):
+            code = np.zeros(len(masses), dtype=np.uint64)
+            for k, shift in word:
+                code |= shifted[:, k] << np.uint64(shift)
+            parts.append(code.astype(dtype).tobytes())
+        return zlib.compress(b"".join(parts))
+
+    # (masses, coeffs) of one encoded block, both int64
+    def decode(self, blob):
+        data = zlib.decompress(blob)
+        rows, first, step_size = struct.unpack_from("<IqB", data)
+        position = struct.calcsize("<IqB")
+        masses = np.full(rows, first, dtype=np.int64)
+        if rows > 1:
+            steps = np.frombuffer(data, dtype=f"<u{step_size}", count=rows - 1, offset=position)
+            masses[1:] += np.cumsum(steps, dtype=np.int64)
+        position += step_size * max(rows - 1, 0)
+        coeffs = np.empty((rows, len(self.lows)), dtype=np.int64)
+        for word, dtype in zip(self.words, self.word_dtypes):
+            code = np.frombuffer(data, dtype=dtype, count=rows, offset=position)
+            position += np.dtype(dtype).itemsize * rows
+            for k, shift in word:
+                field = (code >> code.dtype.type(shift)) & code.dtype.type((1 << self.widths[k]) - 1)
+                np.add(field, self.lows[k], out=coeffs[:, k], casting="unsafe")
+        return masses, coeffs
+
+    # (first mass, last mass, rows, blob) for consecutive blocks of block_rows rows
+    def iter_blocks(self, masses, coeffs, block_rows=PACK_BLOCK_ROWS):
+        for start in range(0, len(masses), block_rows):
+            stop = min(start + block_rows, len(masses))
+            yield (int(masses[start]), int(masses[stop - 1]), stop - start,
+                   self.encode(masses[start:stop], coeffs[start:stop]))
+
+def _uint_dtype(bits):
+    for dtype in ("<u1", "<u2", "<u4"):
+        if bits <= np.dtype(dtype).itemsize * 8:
+            return dtype
+    return "<u8"
+
+# DeltaIndex read from a packed (version 2) file. Only the block directory is
+# searched in place; a lookup decodes just the blocks its mass window overlaps.
+class PackedDeltaIndex(DeltaIndex):
+
+    def __len__(self):
+        return self.size
+
+    # Blocks are located by mass, so the "key range" of a packed index is the mass window itself
+    def window(self, lo_i, hi_i):
+        return lo_i, hi_i
+
+    def rows(self, lo_i, hi_i):
+        masses, coeffs = self._decode_blocks(self._block_range(lo_i, hi_i))
+        keep = (masses >= lo_i) & (masses <= hi_i)
+        return coeffs[keep].astype(_coeff_dtype(self.lows, self.highs)), masses[keep]
+
+    def query_many(self, deltas, ppm_tolerance, rules=None):
+        targets = np.rint(np.asarray(deltas, dtype=np.float64) * SCALE).astype(np.int64)
+        slack = (np.abs(targets) * ppm_tolerance / 1e6).astype(np.int64) + 1
+        starts = np.searchsorted(self.block_last, targets - slack, side="left")
+        stops = np.searchsorted(self.block_first, targets + slack, side="right")
+        counts = np.maximum(stops - starts, 0)
+        blocks = np.unique(np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                           + np.repeat(starts, counts))
+        masses, coeffs = self._decode_blocks(blocks)
+        keys, key_counts = np.unique(masses, return_counts=True)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(key_counts, out=offsets[1:])
+        compositions = coeffs.astype(_coeff_dtype(self.lows, self.highs))
+        return self._match_many(keys, offsets, compositions, targets, slack, ppm_tolerance, rules)
+
+    def _block_range(self, lo_i, hi_i):
+        return np.arange(np.searchsorted(self.block_last, lo_i, side="left"),
+                         np.searchsorted(self.block_first, hi_i, side="right"))
+
+    # Decoded rows of the given (ascending) blocks, still in mass order. The most
+    # recently used cache_blocks decoded blocks are kept, since spectra repeat deltas.
+    def _decode_blocks(self, blocks):
+        decoded = []
+        for b in blocks.tolist():
+            rows = self._cache.pop(b, None)
+            if rows is None:
+                rows = self.packer.decode(self.payload[self.block_offsets[b]:self.block_offsets[b + 1]])
+                if len(self._cache) >= self.cache_blocks:
+                    del self._cache[next(iter(self._cache))]
+            self._cache[b] = rows
+            decoded.append(rows)
+        if not decoded:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, len(self.elements)), dtype=np.int64)
+        return np.concatenate([d[0] for d in decoded]), np.concatenate([d[1] for d in decoded])
+
+# Split element columns into two groups whose lattice sizes are as close as possible
+def _split_halves(lows, highs):
+    sizes = highs - lows + 1
+    halves = ([], [])
+    products = [1, 1]
+    for k in np.argsort(-sizes, kind="stable"):
+        side = 0 if products[0] <= products[1] else 1
+        halves[side].append(int(k))
+        products[side] *= int(sizes[k])
+    return [sorted(h) for h in halves]
+
+# Every composition of one element group with its integer mass, sorted by mass
+def _half_table(columns, mass_i, lows, highs):
+    coeff_blocks = list(iter_lattice_chunks(lows[columns], highs[columns], chunk_size=CHUNK_SIZE))
+    coeffs = np.concatenate(coeff_blocks) if coeff_blocks else np.zeros((1, 0), dtype=np.int64)
+    masses = coeffs @ mass_i[columns]
+    order = np.argsort(masses, kind="stable")
+    return masses[order], coeffs[order]
+
+# Meet-in-the-middle engine: the elements are split into two halves with sorted
+# half-mass tables, and every pair whose summed mass falls inside the ppm window
+# is found by merging the two tables. Memory grows with the half tables (about
+# the square root of the full lattice) plus the matches, not the full lattice.
+@_engine
+def find_delta_formulas_mitm(delta_mass, ppm_tolerance, element_bounds, element_masses=None, rules=None,
+                             chunk_size=CHUNK_SIZE):
+    target_mass_i = int(round(delta_mass * SCALE))
+    elements, mass_i, lows, highs = _prepare(element_bounds, element_masses)
+    if np.any(highs < lows):
+        return empty_result(elements)
+    lo_i, hi_i = _ppm_bounds(target_mass_i, ppm_tolerance)
+
+    left_cols, right_cols = _split_halves(lows, highs)
+    left_masses, left_coeffs = _half_table(left_cols, mass_i, lows, highs)
+    right_masses, right_coeffs = _half_table(right_cols, mass_i, lows, highs)
+
+    # For ascending left masses the matching right window slides monotonically
+    # downwards, so one sorted searchsorted pass per block is the two-pointer merge
+    coeff_blocks = []
+    mass_blocks = []
+    for start in range(0, len(left_masses), chunk_size):
+        block = left_masses[start:start + chunk_size]
+        first = np.searchsorted(right_masses, lo_i - block, side="left")
+        last = np.searchsorted(right_masses, hi_i - block, side="right")
+        counts = last - first
+        if not counts.any():
+            continue
+        left_rows = np.repeat(np.arange(start, start + len(block)), counts)
+        right_rows = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                      + np.repeat(first, counts))
+
+        coeffs = np.empty((len(left_rows), len(elements)), dtype=np.int64)
+        coeffs[:, left_cols] = left_coeffs[left_rows]
+        coeffs[:, right_cols] = right_coeffs[right_rows]
+        coeff_blocks.append(coeffs)
+        mass_blocks.append(left_masses[left_rows] + right_masses[right_rows])
+
+    if not coeff_blocks:
+        return empty_result(elements)
+    coeffs = np.concatenate(coeff_blocks)
+    totals = np.concatenate(mass_blocks)
+    nonzero = np.any(coeffs != 0, axis=1)  # Skip empty formula
+    return _select_candidates(coeffs[nonzero], totals[nonzero], target_mass_i, ppm_tolerance, elements, rules)
+
+# Extended residue table (Boecker & Liptak round-robin) over positive integer masses.
+# ert[i][r] is the smallest mass with residue r modulo the lightest element that can
+# be built from the i + 1 lightest elements, which lets the decomposition walk skip
+# every branch that cannot reach the target.
+class ResidueTable:
+
+    def __init__(self, mass_i):
+        self.mass_i = np.asarray(mass_i, dtype=np.int64)
+        if len(self.mass_i) == 0 or np.any(self.mass_i <= 0):
+            raise ValueError("residue table needs at least one element and positive masses")
+        self.order = np.argsort(self.mass_i, kind="stable")
+        self.weights = [int(w) for w in self.mass_i[self.order]]
+
+        a0 = self.weights[0]
+        inf = np.iinfo(np.int64).max
+        ert = np.full((len(self.weights), a0), inf, dtype=np.int64)
+        ert[0, 0] = 0
+        for i in range(1, len(self.weights)):
+            ai = self.weights[i]
+            row = ert[i - 1].copy()
+            d = math.gcd(a0, ai)
+            for p in range(d):
+                n = int(row[p::d].min())
+                if n == inf:
+                    continue
+                # one trip round the residue class, starting from its minimum
+                for _ in range(a0 // d):
+                    n += ai
+                    r = n % a0
+                    n = min(n, int(row[r]))
+                    row[r] = n
+            ert[i] = row
+        self.ert = ert.tolist()
+
+    # All count vectors (in the caller's element order) with integer mass exactly target_i.
+    # caps gives the per-element upper bound, in the caller's element order.
+    def decompose(self, target_i, caps):
+        if target_i < 0:
+            return []
+        caps = [int(caps[k]) for k in self.order]
+        weights = self.weights
+        a0 = weights[0]
+        counts = [0] * len(weights)
+        found = []
+
+        def walk(m, i):
+            if i == 0:
+                c0, r = divmod(m, a0)
+                if r == 0 and c0 <= caps[0]:
+                    counts[0] = c0
+                    found.append(list(counts))
+                return
+            ai = weights[i]
+            lcm = a0 * ai // math.gcd(a0, ai)
+            step = lcm // ai
+            bounds = self.ert[i - 1]
+            for j in range(min(step, caps[i] + 1)):
+                counts[i] = j
+                rest = m - j * ai
+                lbound = bounds[rest % a0]
+                while rest >= lbound and counts[i] <= caps[i]:
+                    walk(rest, i - 1)
+                    rest -= lcm
+                    counts[i] += step
+            counts[i] = 0
+
+        walk(int(target_i), len(weights) - 1)
+        if not found:
+            return []
+        found = np.array(found, dtype=np.int64)
+        result = np.empty_like(found)
+        result[:, self.order] = found
+        return result
+
+@functools.lru_cache(maxsize=32)
+def _residue_table(mass_key):
+    return ResidueTable(mass_key)
+
+# Mass-decomposition engine for non-negative bounds: instead of enumerating the
+# lattice, every integer mass in the ppm window is decomposed with an extended
+# residue table, so only compositions that hit the window are ever generated.
+@_engine
+def find_delta_formulas_residue(delta_mass, ppm_tolerance, element_bounds, element_masses=None, rules=None):
+    target_mass_i = int(round(delta_mass * SCALE))
+    elements, mass_i, lows, highs = _prepare(element_bounds, element_masses)
+    if np.any(lows < 0):
+        raise ValueError("residue strategy needs non-negative element bounds")
+    if np.any(highs < lows):
+        return empty_result(elements)
+
+    # Elements fixed at their lower bound only contribute a constant offset
+    free = np.flatnonzero(highs > lows)
+    base = int(lows @ mass_i)
+    lo_i, hi_i = _ppm_bounds(target_mass_i, ppm_tolerance)
+    if len(free) == 0:
+        coeffs = lows[np.newaxis, :].copy()
+        candidates = [coeffs] if lo_i <= base <= hi_i else []
+    else:
+        table = _residue_table(tuple(int(m) for m in mass_i[free]))
+        caps = highs[free] - lows[free]
+        candidates = []
+        for target in range(max(lo_i - base, 0), hi_i - base + 1):
+            found = table.decompose(target, caps)
+            if len(found):
+                coeffs = np.tile(lows, (len(found), 1))
+                coeffs[:, free] += found
+                candidates.append(coeffs)
+
+    if not candidates:
+        return empty_result(elements)
+    coeffs = np.concatenate(candidates)
+    coeffs = coeffs[np.any(coeffs != 0, axis=1)]  # Skip empty formula
+    return _select_candidates(coeffs, coeffs @ mass_i, target_mass_i, ppm_tolerance, elements, rules)
+
+# Branch-and-bound engine: elements are visited heaviest first and each level keeps
+# the least and most mass the remaining elements can still add. The admissible
+# counts for an element then follow directly from the ppm window, so subtrees that
+# cannot reach target_mass_i +/- ppm_window are never entered. Linear chemistry
+# rules (RDBE, ratios) are pruned the same way and the parity rule is enforced on
+# the last odd-valence element, so rejected branches are never generated.
+@_engine
+def find_delta_formulas_bnb(delta_mass, ppm_tolerance, element_bounds, element_masses=None, rules=None):
+    target_mass_i = int(round(delta_mass * SCALE))
+    elements, mass_i, lows, highs = _prepare(element_bounds, element_masses)
+    if np.any(highs < lows):
+        return empty_result(elements)
+    lo_i, hi_i = _ppm_bounds(target_mass_i, ppm_tolerance)
+
+    order = element_bounds.order if isinstance(element_bounds, SolverPlan) else np.argsort(-mass_i, kind="stable")
+    n = len(elements)
+    low_c = [int(lows[k]) for k in order]
+    high_c = [int(highs[k]) for k in order]
+
+    # Constraint 0 is the mass window; rule constraints follow with their own bounds
+    constraints, odd = rules.compile(elements) if rules is not None else ([], np.zeros(n, dtype=np.int64))
+    weights = [[int(mass_i[k]) for k in order]]
+    windows = [(lo_i, hi_i)]
+    for w, low, high in constraints:
+        weights.append([float(w[k]) for k in order])
+        windows.append((low - 1e-9, high + 1e-9))
+    odd = [int(odd[k]) for k in order]
+    parity = rules.parity if rules is not None else None
+    parity_level = max((k for k in range(n) if odd[k]), default=-1) if parity is not None else -1
+    if parity is not None and parity_level < 0 and parity != 0:
+        return empty_result(elements)
+
+    # rest_min[j][k] / rest_max[j][k]: range of constraint j reachable by elements k..
+    rest_min = []
+    rest_max = []
+    for w in weights:
+        mins = [0] * (n + 1)
+        maxs = [0] * (n + 1)
+        for k in reversed(range(n)):
+            ends = (low_c[k] * w[k], high_c[k] * w[k])
+            mins[k] = mins[k + 1] + min(ends)
+            maxs[k] = maxs[k + 1] + max(ends)
+        rest_min.append(mins)
+        rest_max.append(maxs)
+    if any(rest_min[j][0] > windows[j][1] or rest_max[j][0] < windows[j][0] for j in range(len(weights))):
+        return empty_result(elements)
+
+    counts = [0] * n
+    found = []
+    mass_w, rule_w = weights[0], weights[1:]
+    mass_min, mass_max = rest_min[0], rest_max[0]
+
+    def walk(k, mass, partials, odd_sum):
+        if k == n:
+            found.append(list(counts))
+            return
+        wk = mass_w[k]
+        first = max(low_c[k], -((mass + mass_max[k + 1] - lo_i) // wk))
+        last = min(high_c[k], (hi_i - mass - mass_min[k + 1]) // wk)
+        for j, w in enumerate(rule_w, start=1):
+            wk = w[k]
+            if wk == 0:
+                continue
+            low, high = windows[j]
+            partial = partials[j - 1]
+            reach_min, reach_max = rest_min[j][k + 1], rest_max[j][k + 1]
+            if wk < 0:
+                wk, low, high = -wk, -high, -low
+                partial, reach_min, reach_max = -partial, -reach_max, -reach_min
+            if low > -math.inf:
+                first = max(first, math.ceil((low - partial - reach_max) / wk))
+            if high < math.inf:
+                last = min(last, math.floor((high - partial - reach_min) / wk))
+        step = 1
+        if k == parity_level:
+            step = 2
+            if (odd_sum + first - parity) % 2:
+                first += 1
+        for c in range(first, last + 1, step):
+            counts[k] = c
+            if rule_w:
+                walk(k + 1, mass + c * mass_w[k], [p + c * w[k] for p, w in zip(partials, rule_w)],
+                     odd_sum + c * odd[k])
+            else:
+                walk(k + 1, mass + c * mass_w[k], partials, odd_sum + c * odd[k])
+
+    walk(0, 0, [0] * len(rule_w), 0)
+    if not found:
+        return empty_result(elements)
+
+    coeffs = np.empty((len(found), n), dtype=np.int64)
+    coeffs[:, order] = np.array(found, dtype=np.int64).reshape(len(found), n)
+    coeffs = coeffs[np.any(coeffs != 0, axis=1)]  # Skip empty formula
+    return _select_candidates(coeffs, coeffs @ mass_i, target_mass_i, ppm_tolerance, elements, rules)
+
+STRATEGIES = {
+    "product": find_delta_formulas_product,
+    "vectorized": find_delta_formulas_vectorized,
+    "mitm": find_delta_formulas_mitm,
+    "residue": find_delta_formulas_residue,
+    "bnb": find_delta_formulas_bnb,
+}
+
+# Core search function to find formulas matching a delta mass.
+# strategy picks the enumeration engine; every engine returns the same records.
+# rules is an optional FormulaRules applied during enumeration. output="records"
+# returns the historical list of dicts; output="array" returns the compact
+# structured array (see result_dtype) and leaves string formatting to the writer.
+def find_delta_formulas(delta_mass, ppm_tolerance, element_bounds, element_masses=None, strategy="bnb", rules=None,
+                        output="records"):
+    if strategy not in STRATEGIES:
+        raise ValueError(f"unknown strategy {strategy!r}; expected one of {sorted(STRATEGIES)}")
+    return STRATEGIES[strategy](delta_mass, ppm_tolerance, element_bounds, element_masses, rules=rules,
+                                output=output)
+
+@functools.lru_cache(maxsize=4)
+def _cached_plan(bounds_key, masses_key):
+    return SolverPlan(dict(bounds_key), dict(masses_key))
+
+# A SolverPlan as is; plain dicts get a plan cached per bounds/masses pair. The cached
+# plans are shared, so nothing may build or keep their index (see find_delta_formulas_batch).
+def _as_plan(element_bounds, element_masses):
+    if isinstance(element_bounds, SolverPlan):
+        return element_bounds
+    elements = [e for e in element_bounds if e in element_masses]
+    return _cached_plan(tuple((e, tuple(element_bounds[e])) for e in elements),
+                        tuple((e, float(element_masses[e])) for e in elements))
+
+# Batched solver: one shared DeltaIndex answers every delta in a single vectorized
+# pass. Returns (offsets, compositions, ppm_errors) as described in
+# DeltaIndex.query_many; composition columns follow the plan's element order, i.e.
+# element_bounds order restricted to elements with a known mass. Pass a SolverPlan
+# to reuse its index; plain dicts build a throwaway index per call, so the cached
+# plans never pin a full composition table in memory.
+def find_delta_formulas_batch(deltas, ppm_tolerance, element_bounds, element_masses=None, rules=None):
+    if isinstance(element_bounds, SolverPlan):
+        index = element_bounds.index()
+    else:
+        index = DeltaIndex(_as_plan(element_bounds, element_masses))
+    return index.query_many(deltas, ppm_tolerance, rules)
+
+# Solve many deltas with one solver call per cluster of near-equal deltas (CH2 or
+# H2O ladders in dense spectra repeat the same delta within tolerance). Integer
+# targets are sorted and cut into clusters spanning at most one tolerance of their
+# first member; a cluster is solved once at its centre with the ppm window widened
+# to cover every member's window, then each member keeps only the rows passing its
+# own exact ppm test, with its own ppm_error and delta_mass. Results equal solving
+# every delta separately. solve defaults to find_delta_formulas and may be any
+# function with its signature (e.g. a timing wrapper). With a DeltaCache, each
+# distinct target of a cluster is looked up at the real ppm first, only the misses
+# are solved, and each one is stored under its own key; widened solves never touch
+# the cache. Returns one array result per delta.
+def find_delta_formulas_clustered(deltas, ppm_tolerance, element_bounds, element_masses=None, strategy="bnb",
+                                  rules=None, solve=None, cache=None):
+    plan = _as_plan(element_bounds, element_masses)
+    solve = solve or find_delta_formulas
+    deltas = np.asarray(deltas, dtype=np.float64)
+    targets = np.rint(deltas * SCALE).astype(np.int64)
+    order = np.argsort(targets, kind="stable")
+    results = [None] * len(deltas)
+
+    start = 0
+    while start < len(order):
+        first = int(targets[order[start]])
+        stop = start + 1
+        while stop < len(order) and targets[order[stop]] - first <= abs(first) * ppm_tolerance / 1e6:
+            stop += 1
+        members = order[start:stop].tolist()
+        start = stop
+
+        # members sharing an integer target share one result
+        distinct, first, inverse = np.unique(targets[members], return_index=True, return_inverse=True)
+        found = [None] * len(distinct)
+        if cache is not None:
+            found = [cache.get(plan, ppm_tolerance, int(target), rules) for target in distinct.tolist()]
+        missing = [k for k, result in enumerate(found) if result is None]
+
+        if len(missing) == 1:
+            k = missing[0]
+            found[k] = solve(deltas[members[first[k]]], ppm_tolerance, plan, strategy=strategy, rules=rules,
+                             output="array")
+        elif missing:
+            miss_targets = distinct[missing]
+            center = int(miss_targets[0] + miss_targets[-1]) // 2
+            reach = np.abs(miss_targets - center) + np.abs(miss_targets) * ppm_tolerance / 1e6
+            widened = float(reach.max()) / abs(center) * 1e6 * (1 + 1e-9)
+            wide = solve(center / SCALE, widened, plan, strategy=strategy, rules=rules, output="array")
+            coeffs = np.column_stack([wide[e] for e in plan.elements]).astype(np.int64).reshape(len(wide), len(plan.elements))
+            totals = coeffs @ plan.mass_i
+            for k, target in zip(missing, miss_targets.tolist()):
+                keep = np.abs((totals - target) / target * 1e6) <= ppm_tolerance
+                found[k] = _pack_result(coeffs[keep], totals[keep], target, plan.elements)
+        if cache is not None:
+            for k in missing:
+                cache.put(plan, ppm_tolerance, int(distinct[k]), found[k], rules)
+
+        for m, k in zip(members, inverse.tolist()):
+            results[m] = found[k]
     return results
+
+# Process-pool entry point: solve one block of deltas with find_delta_formulas_clustered.
+# The plan (and its memory-mapped index_path, if any) and the cache arrive pickled;
+# the cache's new entries are flushed before the block returns. Returns (results,
+# hits, misses) so the caller can add the block's lookups to its own cache stats.
+def solve_delta_block(deltas, ppm_tolerance, plan, strategy="bnb", rules=None, cache=None):
+    if cache is None:
+        return find_delta_formulas_clustered(deltas, ppm_tolerance, plan, strategy=strategy, rules=rules), 0, 0
+    hits, misses = cache.hits, cache.misses
+    results = find_delta_formulas_clustered(deltas, ppm_tolerance, plan, strategy=strategy, rules=rules, cache=cache)
+    cache.flush()
+    return results, cache.hits - hits, cache.misses - misses
+
+# On-disk cache of solved deltas shared across runs and processes. Results depend only
+# on the solver configuration (bounds, masses, scale, ppm, rules) and the integer
+# target mass, so entries are keyed by a hash of the configuration plus the
+# quantized delta; every strategy returns the same rows and shares the entries.
+# SQLite in WAL mode lets any number of readers run next to one writer. Hits and
+# new entries are buffered and written every flush_every lookups (and on flush/
+# close); the least recently used entries beyond max_entries are evicted then.
+class DeltaCache:
+
+    def __init__(self, path, max_entries=1_000_000, flush_every=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self._pending = {}
+        self._touched = {}
+        self._configs = {}
+        self._con = None
+
+    def _connection(self):
+        if self._con is None:
+            self._con = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._con.execute("PRAGMA journal_mode=WAL")
+            self._con.execute("PRAGMA synchronous=NORMAL")
+            self._con.execute("CREATE TABLE IF NOT EXISTS entries (config TEXT NOT NULL, target INTEGER NOT NULL, "
+                              "result BLOB NOT NULL, used REAL NOT NULL, PRIMARY KEY (config, target)) WITHOUT ROWID")
+            self._con.execute("CREATE INDEX IF NOT EXISTS idx_used ON entries (used)")
+        return self._con
+
+    # Hash of everything besides the target mass that the result depends on
+    def config_key(self, plan, ppm_tolerance, rules=None):
+        identity = (plan.key(), float(ppm_tolerance), None if rules is None else json.dumps(rules.describe(), sort_keys=True))
+        if identity not in self._configs:
+            text = json.dumps([plan.describe(), float(ppm_tolerance), rules and rules.describe()], sort_keys=True)
+            self._configs[identity] = hashlib.sha1(text.encode()).hexdigest()
+        return self._configs[identity]
+
+    # Cached array result for an integer target, or None; counts a hit or a miss
+    def get(self, plan, ppm_tolerance, target_i, rules=None):
+        entry = (self.config_key(plan, ppm_tolerance, rules), target_i)
+        results = self._pending.get(entry)
+        if results is None:
+            row = self._connection().execute("SELECT result FROM entries WHERE config = ? AND target = ?",
+                                             entry).fetchone()
+            if row is not None:
+                results = np.frombuffer(row[0], dtype=result_dtype(plan.elements)).copy()
+        if results is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touched[entry] = time.time()
+        self._maybe_flush()
+        return results
+
+    # Buffer the exact result for an integer target at ppm_tolerance
+    def put(self, plan, ppm_tolerance, target_i, results, rules=None):
+        self._pending[(self.config_key(plan, ppm_tolerance, rules), target_i)] = results
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if len(self._pending) + len(self._touched) >= self.flush_every:
+            self.flush()
+
+    # Drop-in for find_delta_formulas that answers from the cache when it can
+    def find_delta_formulas(self, delta_mass, ppm_tolerance, element_bounds, element_masses=None, strategy="bnb",
+                            rules=None, output="records"):
+        if output not in ("records", "array"):
+            raise ValueError(f"unknown output {output!r}; expected 'records' or 'array'")
+        plan = _as_plan(element_bounds, element_masses)
+        target_i = int(round(delta_mass * SCALE))
+        results = self.get(plan, ppm_tolerance, target_i, rules)
+        if results is None:
+            results = find_delta_formulas(delta_mass, ppm_tolerance, plan, strategy=strategy, rules=rules,
+                                          output="array")
+            self.put(plan, ppm_tolerance, target_i, results, rules)
+        return results if output == "array" else to_records(results)
+
+    # Write buffered entries and access times, then evict down to max_entries
+    def flush(self):
+        if not self._pending and not self._touched:
+            return
+        con = self._connection()
+        now = time.time()
+        con.execute("BEGIN IMMEDIATE")
+        con.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                        [(config, target, results.tobytes(), now) for (config, target), results in self._pending.items()])
+        con.executemany("UPDATE entries SET used = ? WHERE config = ? AND target = ?",
+                        [(used, config, target) for (config, target), used in self._touched.items()])
+        excess = con.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.max_entries
+        if excess > 0:
+            con.execute("DELETE FROM entries WHERE (config, target) IN "
+                        "(SELECT config, target FROM entries ORDER BY used LIMIT ?)", (excess,))
+        con.execute("COMMIT")
+        self._pending = {}
+        self._touched = {}
+        logger.debug("delta cache %s: %s", self.path, self.stats())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        self.flush()
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+        logger.debug("delta cache %s closed: %s", self.path, self.stats())
+
+    # Workers open their own connection and start with empty buffers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_con=None, _pending={}, _touched={})
+        return state
@@ -1,18 +1,956 @@
 import sqlite3
+import json
+import os
+import random
+import shutil
+import zlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from logging import getLogger
+from delta_solver import (SCALE, CHUNK_SIZE, PACK_BLOCK_ROWS, CompositionPacker, iter_lattice_chunks, result_dtype,
+                          find_delta_formulas)
+
+NON_NEGATIVE_KINDS = ("fragment", "nl")
+UNCONSTRAINED_KINDS = ("delta", "dl")
+#neutral losses are non-negative compositions like fragments, delta losses are signed
+#count changes like deltas: each pair shares one lattice, so it is stored once
+STORED_KINDS = {"fragment": "fragment", "nl": "fragment", "delta": "delta", "dl": "delta"}
+MANIFEST = "manifest.json"
+STORAGES = ("packed", "rows")
+
+logger = getLogger(__name__)
 
 
 class mzDB:
 
-    def __init__(self):
+    def __init__(self, db_dir, element_masses, element_limits, scale = SCALE, shard_width = 50.0,
+                 max_mass = None, chunk_size = CHUNK_SIZE, jobs = 1, partitions_per_job = 4,
+                 storage = "packed", block_rows = PACK_BLOCK_ROWS):
+        """
+        db_dir holds one sub-directory per stored kind: fragment (also answers nl) and
+        delta (also answers dl), see STORED_KINDS. Each kind is sharded into SQLite files by mass bucket of shard_width Da; rows store the
+        composition and its mass as a scale-integer key. max_mass optionally drops
+        compositions heavier than max_mass Da (by absolute value). Builds are split into
+        partitions run on jobs worker processes.
+
+        storage = "packed" keeps each finished shard as compressed blocks of block_rows
+        mass-sorted rows (see delta_solver.CompositionPacker) with a (first_mass) index
+        over the blocks; storage = "rows" keeps one SQL row per composition with a
+        covering mass index
+        """
+
+        if storage not in STORAGES:
+            raise ValueError(f"unknown storage {storage!r}; expected one of {STORAGES}")
+        self.db_dir = db_dir
+        self.elements = list(element_limits)
+        self.element_masses = {e: float(element_masses[e]) for e in self.elements}
+        self.element_limits = {e: (int(element_limits[e][0]), int(element_limits[e][1])) for e in self.elements}
+        self.scale = scale
+        self.shard_width = shard_width
+        self.max_mass = max_mass
+        self.chunk_size = chunk_size
+        self.jobs = jobs
+        self.partitions_per_job = partitions_per_job
+        self.storage = storage
+        self.block_rows = block_rows
+        self.mass_i = np.array([int(round(self.element_masses[e] * scale)) for e in self.elements],
+                               dtype = np.int64)
+        self._pool = {}
+        self._blocks = {}
+        self._queries = {}
+        self._pool_pid = os.getpid()
+
+
+    def __getstate__(self):
+
+        #sqlite connections do not pickle; each worker opens its own
+        state = self.__dict__.copy()
+        state["_pool"] = {}
+        state["_blocks"] = {}
+        state["_queries"] = {}
+        return state
+
+
+    def _connection(self, path):
+        """
+        pooled read-only connection to a finished shard, one per shard per process.
+        immutable=1 skips file locking and change detection, so the pool is dropped
+        whenever this instance writes to the DB
+        """
+
+        if self._pool_pid != os.getpid():
+            self._pool = {}
+            self._blocks = {}
+            self._pool_pid = os.getpid()
+        if path not in self._pool:
+            self._pool[path] = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri = True,
+                                               check_same_thread = False)
+        return self._pool[path]
+
+
+    def close(self):
+
+        if self._pool_pid == os.getpid():
+            for con in self._pool.values():
+                con.close()
+        self._pool = {}
+        self._blocks = {}
+        self._queries = {}
+        self._pool_pid = os.getpid()
+
+
+    def _block_directory(self, path):
+        """
+        (rowids, first masses, last masses, packer) of a packed shard's blocks in mass
+        order, read once per process alongside the pooled connection
+        """
+
+        con = self._connection(path)
+        if path not in self._blocks:
+            directory = np.array(con.execute("SELECT rowid, first_mass, last_mass FROM blocks "
+                                             "ORDER BY first_mass, rowid").fetchall(), dtype = np.int64).reshape(-1, 3)
+            lows, highs = json.loads(con.execute("SELECT value FROM meta WHERE key = 'pack_bounds'").fetchone()[0])
+            self._blocks[path] = (directory[:, 0], directory[:, 1], directory[:, 2], CompositionPacker(lows, highs))
+        return self._blocks[path]
+
+
+    def _packed_rows(self, path, lows, highs):
+        """
+        rows of a packed shard inside each [lows[i], highs[i]] window: decodes only the
+        blocks some window overlaps, each once. Returns (owner window, masses, coeffs).
+        """
+
+        rowids, first, last, packer = self._block_directory(path)
+        starts = np.searchsorted(last, lows, side = "left")
+        stops = np.searchsorted(first, highs, side = "right")
+        counts = np.maximum(stops - starts, 0)
+        blocks = np.unique(np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                           + np.repeat(starts, counts))
 
-        pass
+        con = self._connection(path)
+        decoded = [packer.decode(con.execute("SELECT data FROM blocks WHERE rowid = ?", (rowid,)).fetchone()[0])
+                   for rowid in rowids[blocks].tolist()]
+        if decoded:
+            masses = np.concatenate([d[0] for d in decoded])
+            coeffs = np.concatenate([d[1] for d in decoded])
+        else:
+            masses, coeffs = np.zeros(0, dtype = np.int64), np.zeros((0, len(self.elements)), dtype = np.int64)
+
+        row_starts = np.searchsorted(masses, lows, side = "left")
+        row_counts = np.searchsorted(masses, highs, side = "right") - row_starts
+        row_counts = np.maximum(row_counts, 0)
+        owner = np.repeat(np.arange(len(lows)), row_counts)
+        rows = (np.arange(row_counts.sum()) - np.repeat(np.cumsum(row_counts) - row_counts, row_counts)
+                + np.repeat(row_starts, row_counts))
+        return owner, masses[rows], coeffs[rows]
+
+
+    def stored_kind(self, kind):
+
+        return STORED_KINDS.get(kind, kind)
+
+
+    def kind_dir(self, kind):
+
+        return os.path.join(self.db_dir, self.stored_kind(kind))
+
+
+    def shard_name(self, bucket):
+
+        return f"shard_{bucket:+06d}.sqlite"
+
+
+    def bucket_of(self, masses):
+        """
+        shard bucket of each scale-integer mass
+        """
+
+        return np.floor_divide(masses, int(round(self.shard_width * self.scale)))
+
+
+    def kind_bounds(self, kind):
+        """
+        per-element (lows, highs) of the lattice stored for a kind: non-negative kinds
+        clip the configured limits at zero, unconstrained kinds allow the same count
+        change in either direction
+        """
+
+        lows = []
+        highs = []
+        for e in self.elements:
+            lo, hi = self.element_limits[e]
+            if kind in NON_NEGATIVE_KINDS:
+                lows.append(max(lo, 0))
+                highs.append(max(hi, 0))
+            else:
+                reach = max(abs(lo), abs(hi))
+                lows.append(-reach)
+                highs.append(reach)
+        return np.array(lows, dtype = np.int64), np.array(highs, dtype = np.int64)
 
 
     def write_dbs(self):
-        """ 
+        """
         Should create all possible mzs at a given level of precision and write everything to
-        a local directory with sqlite file dbs...possibilities will be segmented by 
+        a local directory with sqlite file dbs...possibilities will be segmented by
         fragment, NL, delta, DL
         """
 
-        pass
+        self.create_non_negative_dbs()
+        self.create_unconstrained_dbs()
+
+
+    def create_non_negative_dbs(self, kinds = NON_NEGATIVE_KINDS, rebuild = False):
+
+        for kind in dict.fromkeys(self.stored_kind(kind) for kind in kinds):
+            self.build_kind(kind) if rebuild else self.update_kind(kind)
+
+
+    def create_unconstrained_dbs(self, kinds = UNCONSTRAINED_KINDS, rebuild = False):
+
+        for kind in dict.fromkeys(self.stored_kind(kind) for kind in kinds):
+            self.build_kind(kind) if rebuild else self.update_kind(kind)
+
+
+    def update_kind(self, kind):
+        """
+        bring an existing kind in line with the current limits and precision without a full
+        rebuild where possible:
+          - limits that grew: only the newly admitted composition slabs are enumerated
+            and merged into the shards
+          - limits that shrank: nothing is rebuilt, query filters to the current limits
+          - precision (scale) changed: masses are recomputed from the stored compositions
+            and every row is re-bucketed into fresh shards
+        a missing or incompatible DB (different elements, masses, shard width or mass
+        cap) is rebuilt from scratch.
+
+        Like build_kind, the work is staged before any shard is touched: every slab (and,
+        for a rescale, every stored shard) is written to its own partition under update/
+        with a done marker, then merged. Each merge writes a fresh shard file that replaces
+        the old one and keeps only the old shard's rows inside the old bounds, so merging
+        again after a crash cannot duplicate rows. The manifest is written last. A staged
+        update whose partitions all finished is completed before anything else, so it is
+        always safe to rerun.
+        """
+
+        self.close()
+        try:
+            manifest = self.read_manifest(kind)
+        except FileNotFoundError:
+            return self.build_kind(kind)
+        if (manifest["elements"] != self.elements or manifest["element_masses"] != self.element_masses
+                or manifest["shard_width"] != self.shard_width or manifest["max_mass"] != self.max_mass
+                or manifest.get("storage", "rows") != self.storage):
+            logger.info(f"{kind}: DB built with different elements or layout, rebuilding")
+            return self.build_kind(kind)
+
+        update_dir = os.path.join(self.kind_dir(kind), "update")
+        plan_path = os.path.join(update_dir, "update.json")
+        staged = None
+        if os.path.exists(plan_path):
+            with open(plan_path) as handle:
+                staged = json.load(handle)
+            if all(self._part_done(update_dir, part) is not None for part in range(len(staged["partitions"]))):
+                logger.info(f"{kind}: finishing an interrupted update")
+                manifest = self._apply_update(kind, manifest, staged)
+                staged = None
+
+        lows, highs = self.kind_bounds(kind)
+        old_lows = np.array([manifest["bounds"][e][0] for e in self.elements], dtype = np.int64)
+        old_highs = np.array([manifest["bounds"][e][1] for e in self.elements], dtype = np.int64)
+        new_lows, new_highs = np.minimum(lows, old_lows), np.maximum(highs, old_highs)
+
+        #a rescale re-masses every stored row, so the stored shards become partitions too
+        partitions = []
+        if manifest["scale"] != self.scale:
+            partitions.extend({"shard": name} for name in sorted(manifest["shards"]))
+        partitions.extend({"lows": slab_lows.tolist(), "highs": slab_highs.tolist()}
+                          for slab_lows, slab_highs in self.added_slabs(old_lows, old_highs, new_lows, new_highs))
+        if not partitions:
+            if os.path.exists(update_dir):
+                shutil.rmtree(update_dir)
+            if manifest["scale"] != self.scale:
+                manifest["scale"] = self.scale
+                self._write_manifest(kind, manifest)
+            return manifest
+
+        update_plan = {
+            "scale": self.scale,
+            "rescale": manifest["scale"] != self.scale,
+            "old_bounds": [old_lows.tolist(), old_highs.tolist()],
+            "new_bounds": [new_lows.tolist(), new_highs.tolist()],
+            "partitions": partitions,
+        }
+        #partitions of an unfinished plan only ever touch update/, so a stale one is dropped
+        if staged != update_plan:
+            if os.path.exists(update_dir):
+                shutil.rmtree(update_dir)
+            os.makedirs(update_dir)
+            with open(plan_path + ".tmp", "w") as handle:
+                json.dump(update_plan, handle)
+            os.replace(plan_path + ".tmp", plan_path)
+        if update_plan["rescale"]:
+            logger.info(f"{kind}: rescaling masses from {manifest['scale']} to {self.scale}")
+        logger.info(f"{kind}: updating with {len(partitions)} partitions")
+
+        pending = []
+        for part, partition in enumerate(partitions):
+            if self._part_done(update_dir, part) is None:
+                if "shard" in partition:
+                    source = os.path.join(self.kind_dir(kind), partition["shard"])
+                    pending.append((update_dir, part, None, None, source))
+                else:
+                    pending.append((update_dir, part, np.array(partition["lows"], dtype = np.int64),
+                                    np.array(partition["highs"], dtype = np.int64)))
+        self._run_partitions(kind, pending)
+        return self._apply_update(kind, manifest, update_plan)
+
+
+    def _apply_update(self, kind, manifest, update_plan):
+        """
+        merge the finished partitions of a staged update into the shards and write the
+        manifest. A rescale rebuilds every shard from its partitions alone; otherwise the
+        partitions are merged with the old shard's rows inside the old bounds.
+        """
+
+        update_dir = os.path.join(self.kind_dir(kind), "update")
+        buckets = {}
+        for part in range(len(update_plan["partitions"])):
+            for bucket in self._part_done(update_dir, part):
+                buckets.setdefault(int(bucket), []).append(part)
+
+        lows, highs = update_plan["new_bounds"]
+        for bucket, parts in sorted(buckets.items()):
+            name = self.shard_name(bucket)
+            path = os.path.join(self.kind_dir(kind), name)
+            sources = [os.path.join(self._part_dir(update_dir, part), name) for part in parts]
+            keep_bounds = None
+            if not update_plan["rescale"] and name in manifest["shards"]:
+                keep_bounds = update_plan["old_bounds"]
+            manifest["shards"][name] = self._merge_shard(path, sources, bucket, lows, highs, keep_bounds)
+
+        if update_plan["rescale"]:
+            for name, info in list(manifest["shards"].items()):
+                if info["bucket"] not in buckets:
+                    path = os.path.join(self.kind_dir(kind), name)
+                    if os.path.exists(path):
+                        os.remove(path)
+                    del manifest["shards"][name]
+            manifest["scale"] = update_plan["scale"]
+        manifest["bounds"] = {e: [int(lo), int(hi)] for e, lo, hi in zip(self.elements, lows, highs)}
+        self._write_manifest(kind, manifest)
+        shutil.rmtree(update_dir)
+        logger.info(f"{kind}: merged {len(buckets)} updated shards")
+        return manifest
+
+
+    def added_slabs(self, old_lows, old_highs, new_lows, new_highs):
+        """
+        disjoint boxes covering new box minus old box (new contains old): in slab k the
+        elements before k keep their old range, element k takes the values outside its old
+        range, and the elements after k take their full new range
+        """
+
+        for k in range(len(old_lows)):
+            for lo, hi in ((new_lows[k], old_lows[k] - 1), (old_highs[k] + 1, new_highs[k])):
+                if lo > hi:
+                    continue
+                slab_lows = np.concatenate([old_lows[:k], [lo], new_lows[k + 1:]]).astype(np.int64)
+                slab_highs = np.concatenate([old_highs[:k], [hi], new_highs[k + 1:]]).astype(np.int64)
+                yield slab_lows, slab_highs
+
+
+    def build_kind(self, kind):
+        """
+        build one kind from independent leading-element slab partitions. Partitions run on
+        a process pool when jobs > 1; each one writes its own unindexed shard files and a
+        done marker, so an interrupted build resumes with only the unfinished partitions.
+        The partial shards are then merged bucket by bucket into the final mass-sorted
+        shards, indexes are created, and the manifest is written last to mark the kind
+        complete.
+        """
+
+        #pooled immutable connections must not outlive the shard files removed below
+        self.close()
+        lows, highs = self.kind_bounds(kind)
+        manifest = self._manifest(kind, lows, highs)
+        out_dir = self.kind_dir(kind)
+        parts_dir = os.path.join(out_dir, "parts")
+        plan_path = os.path.join(parts_dir, "build.json")
+
+        #resume only a build of exactly the same parameters and partitioning
+        partitions = self.partitions(lows, highs)
+        build_plan = dict(manifest, partitions = [[lo.tolist(), hi.tolist()] for lo, hi in partitions])
+        resumable = False
+        if os.path.exists(plan_path):
+            with open(plan_path) as handle:
+                resumable = json.load(handle) == build_plan
+        if not resumable:
+            if os.path.exists(out_dir):
+                shutil.rmtree(out_dir)
+            os.makedirs(parts_dir)
+            with open(plan_path, "w") as handle:
+                json.dump(build_plan, handle)
+
+        pending = []
+        for part, (part_lows, part_highs) in enumerate(partitions):
+            if self._part_done(parts_dir, part) is None:
+                pending.append((parts_dir, part, part_lows, part_highs))
+        logger.info(f"{kind}: {len(partitions)} partitions, {len(partitions) - len(pending)} already built")
+        self._run_partitions(kind, pending)
+
+        #merge partial shards bucket by bucket
+        buckets = {}
+        for part in range(len(partitions)):
+            for bucket in self._part_done(parts_dir, part):
+                buckets.setdefault(int(bucket), []).append(part)
+
+        for name in os.listdir(out_dir):
+            if name.startswith("shard_"):
+                os.remove(os.path.join(out_dir, name))
+        for bucket, parts in sorted(buckets.items()):
+            path = os.path.join(out_dir, self.shard_name(bucket))
+            sources = [os.path.join(self._part_dir(parts_dir, part), self.shard_name(bucket)) for part in parts]
+            manifest["shards"][self.shard_name(bucket)] = self._merge_shard(path, sources, bucket, lows, highs)
+
+        self._write_manifest(kind, manifest)
+        shutil.rmtree(parts_dir)
+        logger.info(f"{kind}: merged {len(buckets)} shards")
+        return manifest
+
+
+    def partitions(self, lows, highs):
+        """
+        split the lattice into leading-element slabs: the first elements are fixed to
+        single values until there are at least partitions_per_job * jobs slabs
+        """
+
+        target = max(1, self.jobs * self.partitions_per_job)
+        fixed = 0
+        count = 1
+        while fixed < len(lows) and count < target:
+            count *= int(highs[fixed] - lows[fixed] + 1)
+            fixed += 1
+
+        slabs = []
+        for prefix in iter_lattice_chunks(lows[:fixed], highs[:fixed], chunk_size = max(count, 1)):
+            for values in prefix:
+                slab_lows, slab_highs = lows.copy(), highs.copy()
+                slab_lows[:fixed] = values
+                slab_highs[:fixed] = values
+                slabs.append((slab_lows, slab_highs))
+        return slabs
+
+
+    def _run_partitions(self, kind, pending):
+        """
+        run _build_partition over the pending tasks, on a process pool when jobs > 1
+        """
+
+        if self.jobs > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers = self.jobs) as pool:
+                futures = [pool.submit(self._build_partition, *task) for task in pending]
+                for finished, future in enumerate(as_completed(futures), start = 1):
+                    future.result()
+                    logger.info(f"{kind}: partition {finished}/{len(pending)} done")
+        else:
+            for finished, task in enumerate(pending, start = 1):
+                self._build_partition(*task)
+                logger.info(f"{kind}: partition {finished}/{len(pending)} done")
+
+
+    def _part_dir(self, parts_dir, part):
+
+        return os.path.join(parts_dir, f"part_{part:06d}")
+
+
+    def _part_done(self, parts_dir, part):
+        """
+        bucket -> row count of a finished partition, or None if it has not finished
+        """
+
+        marker = os.path.join(self._part_dir(parts_dir, part), "done.json")
+        if not os.path.exists(marker):
+            return None
+        with open(marker) as handle:
+            return json.load(handle)
+
+
+    def _build_partition(self, parts_dir, part, lows, highs, source = None):
+        """
+        enumerate one slab (or, given a source shard, re-mass its stored rows at the
+        current scale) into unindexed per-bucket shard files, then write the done marker
+        """
+
+        part_dir = self._part_dir(parts_dir, part)
+        if os.path.exists(part_dir):
+            shutil.rmtree(part_dir)
+        os.makedirs(part_dir)
+
+        shards = {}
+        counts = {}
+        chunks = iter_lattice_chunks(lows, highs, self.chunk_size) if source is None else self._stored_chunks(source)
+        for coeffs in chunks:
+            masses, coeffs = self._keep_rows(coeffs)
+            for bucket, rows in self._split_buckets(masses, coeffs):
+                if bucket not in shards:
+                    shards[bucket] = self._open_shard(os.path.join(part_dir, self.shard_name(bucket)))
+                self._insert(shards[bucket], rows)
+                counts[bucket] = counts.get(bucket, 0) + len(rows)
+
+        for con in shards.values():
+            con.execute("COMMIT")
+            con.close()
+        with open(os.path.join(part_dir, "done.json.tmp"), "w") as handle:
+            json.dump(counts, handle)
+        os.replace(os.path.join(part_dir, "done.json.tmp"), os.path.join(part_dir, "done.json"))
+        return counts
+
+
+    def _stored_chunks(self, path):
+        """
+        composition blocks of a finished shard, packed or not, read without the pool
+        """
+
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri = True)
+        if con.execute("SELECT 1 FROM sqlite_master WHERE name = 'blocks'").fetchone():
+            lows, highs = json.loads(con.execute("SELECT value FROM meta WHERE key = 'pack_bounds'").fetchone()[0])
+            packer = CompositionPacker(lows, highs)
+            for (blob,) in con.execute("SELECT data FROM blocks ORDER BY first_mass, rowid").fetchall():
+                yield packer.decode(blob)[1]
+        else:
+            cursor = con.execute(f"SELECT {self._columns()} FROM compositions")
+            while True:
+                chunk = cursor.fetchmany(self.chunk_size)
+                if not chunk:
+                    break
+                yield np.array(chunk, dtype = np.int64)
+        con.close()
+
+
+    def _merge_shard(self, path, sources, bucket, lows, highs, keep_bounds = None):
+        """
+        copy every partition's rows for one bucket into a staging table, then write the
+        final table in mass order and index (or pack) it. With keep_bounds = (lows, highs)
+        the existing shard at path is merged in too, restricted to that box. The shard is
+        written to a temporary file that replaces path only once complete.
+        """
+
+        tmp = path + ".tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if keep_bounds is not None:
+            shutil.copyfile(path, tmp)
+        con = self._open_shard(tmp)
+        con.execute("CREATE TEMP TABLE staging AS SELECT * FROM compositions WHERE 0")
+        if keep_bounds is not None:
+            inside = " AND ".join(f'"{e}" BETWEEN ? AND ?' for e in self.elements) or "1"
+            params = [int(v) for lo, hi in zip(*keep_bounds) for v in (lo, hi)]
+            con.execute(f"INSERT INTO staging SELECT * FROM compositions WHERE {inside}", params)
+            con.execute("DELETE FROM compositions")
+        for i, source in enumerate(sources):
+            con.execute("COMMIT")
+            con.execute("ATTACH DATABASE ? AS part", (source,))
+            con.execute("BEGIN")
+            con.execute("INSERT INTO staging SELECT * FROM part.compositions")
+            con.execute("COMMIT")
+            con.execute("DETACH DATABASE part")
+            con.execute("BEGIN")
+        con.execute(f"INSERT INTO compositions SELECT * FROM staging ORDER BY mass, {self._columns()}")
+        con.execute("DROP TABLE staging")
+        info = self._finish_shard(con, bucket, lows, highs)
+        os.replace(tmp, path)
+        return info
+
+
+    def _keep_rows(self, coeffs):
+        """
+        drop the empty composition and anything above max_mass; returns (masses, coeffs)
+        """
+
+        coeffs = coeffs[np.any(coeffs != 0, axis = 1)]
+        masses = coeffs @ self.mass_i
+        if self.max_mass is not None:
+            keep = np.abs(masses) <= int(round(self.max_mass * self.scale))
+            masses, coeffs = masses[keep], coeffs[keep]
+        return masses, coeffs
+
+
+    def _split_buckets(self, masses, coeffs):
+        """
+        yield (bucket, rows) with rows sorted by mass, ready for executemany
+        """
+
+        order = np.argsort(masses, kind = "stable")
+        masses, coeffs = masses[order], coeffs[order]
+        buckets = self.bucket_of(masses)
+        edges = np.flatnonzero(np.diff(buckets)) + 1
+        for start, stop in zip(np.r_[0, edges], np.r_[edges, len(masses)]):
+            if start == stop:
+                continue
+            rows = np.column_stack([masses[start:stop], coeffs[start:stop]])
+            yield int(buckets[start]), rows.tolist()
+
+
+    def _columns(self, table = ""):
+
+        return ", ".join(f'{table}"{e}"' for e in self.elements)
+
+
+    def _open_shard(self, path):
+
+        con = sqlite3.connect(path, isolation_level = None)
+        con.execute("PRAGMA journal_mode = OFF")
+        con.execute("PRAGMA synchronous = OFF")
+        element_cols = "".join(f', "{e}" INTEGER NOT NULL' for e in self.elements)
+        con.execute(f"CREATE TABLE IF NOT EXISTS compositions (mass INTEGER NOT NULL{element_cols})")
+        con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        con.execute("BEGIN")
+        if con.execute("SELECT 1 FROM sqlite_master WHERE name = 'blocks'").fetchone():
+            self._unpack_shard(con)
+        return con
+
+
+    def _insert(self, con, rows):
+
+        placeholders = ", ".join("?" * (len(self.elements) + 1))
+        con.executemany(f"INSERT INTO compositions (mass, {self._columns()}) VALUES ({placeholders})", rows)
+
+
+    def _finish_shard(self, con, bucket, lows, highs):
+        """
+        commit the load, then build the covering (mass, elements...) index, or pack the
+        rows into blocks laid out for the (lows, highs) box, and record shard metadata
+        """
+
+        con.execute("COMMIT")
+        if self.storage == "packed":
+            rows, low, high = self._pack_shard(con, lows, highs)
+        else:
+            con.execute(f"CREATE INDEX IF NOT EXISTS idx_mass ON compositions (mass, {self._columns()})")
+            rows, low, high = con.execute("SELECT COUNT(*), MIN(mass), MAX(mass) FROM compositions").fetchone()
+        info = {"bucket": bucket, "rows": rows, "min_mass": low, "max_mass": high}
+        con.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                        [(key, json.dumps(value)) for key, value in info.items()])
+        path = con.execute("PRAGMA database_list").fetchone()[2]
+        con.close()
+        info["crc32"] = self.file_checksum(path)
+        return info
+
+
+    def file_checksum(self, path):
+
+        checksum = 0
+        with open(path, "rb") as handle:
+            for block in iter(lambda: handle.read(1 << 20), b""):
+                checksum = zlib.crc32(block, checksum)
+        return checksum
+
+
+    def _pack_shard(self, con, lows, highs):
+        """
+        replace the compositions table with compressed blocks of block_rows mass-sorted
+        rows; returns (rows, min mass, max mass)
+        """
+
+        packer = CompositionPacker(lows, highs)
+        con.execute("BEGIN")
+        con.execute("CREATE TABLE blocks (first_mass INTEGER NOT NULL, last_mass INTEGER NOT NULL, "
+                    "rows INTEGER NOT NULL, data BLOB NOT NULL)")
+        cursor = con.execute(f"SELECT mass, {self._columns()} FROM compositions ORDER BY mass, {self._columns()}")
+        while True:
+            chunk = cursor.fetchmany(self.block_rows)
+            if not chunk:
+                break
+            table = np.array(chunk, dtype = np.int64)
+            con.executemany("INSERT INTO blocks VALUES (?, ?, ?, ?)",
+                            packer.iter_blocks(table[:, 0], table[:, 1:], self.block_rows))
+        con.execute("DROP TABLE compositions")
+        con.execute("CREATE INDEX idx_blocks ON blocks (first_mass)")
+        con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pack_bounds', ?)",
+                    (json.dumps([[int(lo) for lo in lows], [int(hi) for hi in highs]]),))
+        con.execute("COMMIT")
+        con.execute("VACUUM")
+        rows, low, high = con.execute("SELECT SUM(rows), MIN(first_mass), MAX(last_mass) FROM blocks").fetchone()
+        return rows or 0, low, high
+
+
+    def _unpack_shard(self, con):
+        """
+        turn a packed shard back into a compositions table (inside the open transaction)
+        so rows can be added or updated; _finish_shard packs it again
+        """
+
+        lows, highs = json.loads(con.execute("SELECT value FROM meta WHERE key = 'pack_bounds'").fetchone()[0])
+        packer = CompositionPacker(lows, highs)
+        for (blob,) in con.execute("SELECT data FROM blocks ORDER BY first_mass, rowid").fetchall():
+            masses, coeffs = packer.decode(blob)
+            self._insert(con, np.column_stack([masses, coeffs]).tolist())
+        con.execute("DROP TABLE blocks")
+
+
+    def _manifest(self, kind, lows, highs):
+
+        return {
+            "kind": self.stored_kind(kind),
+            "elements": self.elements,
+            "element_masses": self.element_masses,
+            "bounds": {e: [int(lo), int(hi)] for e, lo, hi in zip(self.elements, lows, highs)},
+            "scale": self.scale,
+            "shard_width": self.shard_width,
+            "max_mass": self.max_mass,
+            "storage": self.storage,
+            "shards": {},
+        }
+
+
+    def _write_manifest(self, kind, manifest):
+
+        path = os.path.join(self.kind_dir(kind), MANIFEST)
+        with open(path + ".tmp", "w") as handle:
+            json.dump(manifest, handle, indent = 1)
+        os.replace(path + ".tmp", path)
+
+
+    def read_manifest(self, kind):
+
+        with open(os.path.join(self.kind_dir(kind), MANIFEST)) as handle:
+            return json.load(handle)
+
+
+    def query(self, delta_mass, ppm_tolerance, kind = "delta"):
+        """
+        compositions of a kind within ppm_tolerance of delta_mass, answered with an
+        indexed range scan on the covering mass index of the shards the window touches.
+        Returns a delta_solver result array, rows in the same order find_delta_formulas
+        would return them.
+        """
+
+        target = int(round(delta_mass * self.scale))
+        slack = int(abs(target) * ppm_tolerance / 1e6) + 1
+        low, high = target - slack, target + slack
+        manifest, bounds_sql, bounds_params = self._query_setup(kind)
+
+        rows = []
+        for bucket in range(int(self.bucket_of(low)), int(self.bucket_of(high)) + 1):
+            path = os.path.join(self.kind_dir(kind), self.shard_name(bucket))
+            if self.shard_name(bucket) not in manifest["shards"]:
+                continue
+            if manifest.get("storage", "rows") == "packed":
+                _, masses, coeffs = self._packed_rows(path, np.array([low]), np.array([high]))
+                keep = self._bounds_mask(kind, coeffs)
+                rows.extend(np.column_stack([masses[keep], coeffs[keep]]).tolist())
+                continue
+            rows.extend(self._connection(path).execute(f"SELECT mass, {self._columns()} FROM compositions "
+                                                       f"WHERE mass BETWEEN ? AND ?{bounds_sql}",
+                                                       (low, high, *bounds_params)).fetchall())
+        return self._result_array(rows, target, ppm_tolerance)
+
+
+    def query_many(self, delta_masses, ppm_tolerance, kind = "delta"):
+        """
+        all lookups of a batch in one pass per shard: the ppm windows falling in a shard
+        are loaded into a temp table and joined against the covering mass index, so
+        SQLite walks every window without a Python round-trip per mass. Statements are
+        fixed strings and reuse the connection's prepared statement cache. Packed shards
+        are answered by a sorted merge instead: the windows are matched against the block
+        directory and every overlapped block is fetched and decoded once.
+
+        Returns (offsets, compositions, ppm_errors) like DeltaIndex.query_many: the
+        matches of delta_masses[i] are rows offsets[i]:offsets[i + 1], compositions in
+        element order and rows of each mass in the order query would return them.
+        """
+
+        targets = np.rint(np.asarray(delta_masses, dtype = np.float64) * self.scale).astype(np.int64)
+        slack = (np.abs(targets) * ppm_tolerance / 1e6).astype(np.int64) + 1
+        lows, highs = targets - slack, targets + slack
+        manifest, join_sql, bounds_params = self._query_setup(kind, table = "c.")
+
+        #a window spanning a shard boundary is sent to both shards, clipped rows cannot repeat
+        first, last = self.bucket_of(lows), self.bucket_of(highs)
+        owners, tables = [], []
+        for bucket in np.unique(np.concatenate([first, last])).tolist():
+            name = self.shard_name(bucket)
+            if name not in manifest["shards"]:
+                continue
+            hits = np.flatnonzero((first <= bucket) & (last >= bucket))
+            if manifest.get("storage", "rows") == "packed":
+                owner, masses, coeffs = self._packed_rows(os.path.join(self.kind_dir(kind), name),
+                                                          lows[hits], highs[hits])
+                keep = self._bounds_mask(kind, coeffs)
+                owners.append(hits[owner[keep]])
+                tables.append(np.column_stack([masses[keep], coeffs[keep]]))
+                continue
+            con = self._connection(os.path.join(self.kind_dir(kind), name))
+            con.execute("CREATE TEMP TABLE IF NOT EXISTS windows (id INTEGER PRIMARY KEY, low INTEGER, high INTEGER)")
+            con.execute("DELETE FROM windows")
+            con.executemany("INSERT INTO windows VALUES (?, ?, ?)",
+                            zip(hits.tolist(), lows[hits].tolist(), highs[hits].tolist()))
+            rows = con.execute(f"SELECT w.id, c.mass, {self._columns('c.')} FROM windows w JOIN compositions c "
+                               f"ON c.mass BETWEEN w.low AND w.high{join_sql}", bounds_params).fetchall()
+            if rows:
+                table = np.array(rows, dtype = np.int64)
+                owners.append(table[:, 0])
+                tables.append(table[:, 1:])
+
+        width = len(self.elements)
+        owner = np.concatenate(owners) if owners else np.zeros(0, dtype = np.int64)
+        table = np.concatenate(tables) if tables else np.zeros((0, width + 1), dtype = np.int64)
+        owner_targets = targets[owner]
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            ppm_errors = (table[:, 0] - owner_targets) / owner_targets * 1e6
+        keep = np.abs(ppm_errors) <= ppm_tolerance
+        owner, compositions, ppm_errors = owner[keep], table[keep, 1:], ppm_errors[keep]
+
+        order = np.lexsort(tuple(compositions.T[::-1]) + (owner,))
+        offsets = np.zeros(len(targets) + 1, dtype = np.int64)
+        np.cumsum(np.bincount(owner, minlength = len(targets)), out = offsets[1:])
+        return offsets, compositions[order].astype(result_dtype(self.elements)[0]), ppm_errors[order]
+
+
+    def verify(self, kind, sample = 100, ppm_tolerance = 5.0, seed = 0):
+        """
+        integrity report for one kind: the manifest exists and covers the current settings,
+        every shard is present with its recorded checksum and row count, and a random
+        sample of answers equals delta_solver.find_delta_formulas, both from query and
+        from one query_many batch (its CSR slices). Sampled masses are real compositions
+        of the kind's lattice, jittered inside the tolerance, so most of them have
+        matches. Returns a dict; problems lists everything found.
+        """
+
+        report = {"kind": kind, "shards": 0, "rows": 0, "sampled": 0, "mismatches": 0, "batch_mismatches": 0,
+                  "problems": []}
+        try:
+            manifest = self.read_manifest(kind)
+        except FileNotFoundError:
+            report["problems"].append("no manifest: kind was never built or its build did not finish")
+            return report
+        for key in ("element_masses", "shard_width", "max_mass"):
+            if manifest[key] != getattr(self, key):
+                report["problems"].append(f"{key} differs from the current settings")
+        if manifest.get("storage", "rows") != self.storage:
+            report["problems"].append(f"storage is {manifest.get('storage', 'rows')}, expected {self.storage}")
+        try:
+            self.bounds_filter(kind, manifest)
+        except ValueError as error:
+            report["problems"].append(str(error))
+
+        for name, info in sorted(manifest["shards"].items()):
+            path = os.path.join(self.kind_dir(kind), name)
+            report["shards"] += 1
+            report["rows"] += info["rows"]
+            if not os.path.exists(path):
+                report["problems"].append(f"{name}: missing")
+            elif "crc32" not in info:
+                report["problems"].append(f"{name}: no checksum recorded")
+            elif self.file_checksum(path) != info["crc32"]:
+                report["problems"].append(f"{name}: checksum mismatch")
+            else:
+                con = self._connection(path)
+                if manifest.get("storage", "rows") == "packed":
+                    rows = con.execute("SELECT SUM(rows) FROM blocks").fetchone()[0] or 0
+                else:
+                    rows = con.execute("SELECT COUNT(*) FROM compositions").fetchone()[0]
+                if rows != info["rows"]:
+                    report["problems"].append(f"{name}: {rows} rows, manifest records {info['rows']}")
+        #find_delta_formulas solves at the solver's SCALE only
+        if report["problems"] or self.scale != SCALE:
+            return report
+
+        rng = random.Random(seed)
+        cap = None if self.max_mass is None else int(round(self.max_mass * self.scale))
+        lows, highs = self.kind_bounds(kind)
+        bounds = {e: (int(lo), int(hi)) for e, lo, hi in zip(self.elements, lows, highs)}
+        masses, expected_all = [], []
+        for _ in range(sample):
+            coeffs = np.array([rng.randint(lo, hi) for lo, hi in bounds.values()], dtype = np.int64)
+            mass = int(coeffs @ self.mass_i) / self.scale
+            if mass == 0 or (cap is not None and abs(mass) * self.scale > cap):
+                continue
+            mass *= 1 + rng.uniform(-0.5, 0.5) * ppm_tolerance / 1e6
+            expected = find_delta_formulas(mass, ppm_tolerance, bounds, self.element_masses, output = "array")
+            found = self.query(mass, ppm_tolerance, kind)
+            if cap is not None:
+                totals = np.column_stack([expected[e] for e in self.elements]).astype(np.int64) @ self.mass_i
+                expected = expected[np.abs(totals) <= cap]
+            report["sampled"] += 1
+            masses.append(mass)
+            expected_all.append(expected)
+            if len(found) != len(expected) or any(not np.array_equal(found[e], expected[e]) for e in self.elements):
+                report["mismatches"] += 1
+
+        offsets, compositions, ppm_errors = self.query_many(np.array(masses), ppm_tolerance, kind)
+        for i, expected in enumerate(expected_all):
+            rows = slice(offsets[i], offsets[i + 1])
+            if (offsets[i + 1] - offsets[i] != len(expected)
+                    or any(not np.array_equal(compositions[rows, k], expected[e]) for k, e in enumerate(self.elements))
+                    or not np.allclose(ppm_errors[rows], expected["ppm_error"], rtol = 0, atol = 1e-9)):
+                report["batch_mismatches"] += 1
+        if report["mismatches"]:
+            report["problems"].append(f"{report['mismatches']} of {report['sampled']} sampled queries differ "
+                                      "from find_delta_formulas")
+        if report["batch_mismatches"]:
+            report["problems"].append(f"{report['batch_mismatches']} of {report['sampled']} sampled query_many "
+                                      "answers differ from find_delta_formulas")
+        return report
+
+
+    def _query_setup(self, kind, table = ""):
+        """
+        (manifest, bounds SQL, bounds params) for queries of a kind, parsed once and kept
+        until close(), which every build and update runs first
+        """
+
+        if (kind, table) not in self._queries:
+            manifest = self.read_manifest(kind)
+            self._queries[(kind, table)] = (manifest, *self.bounds_filter(kind, manifest, table = table))
+        return self._queries[(kind, table)]
+
+
+    def bounds_filter(self, kind, manifest, table = ""):
+        """
+        SQL condition restricting a DB built with wider limits to the current ones; raises
+        if the DB does not cover the current limits or precision (run update_kind)
+        """
+
+        if manifest["elements"] != self.elements or manifest["scale"] != self.scale:
+            raise ValueError(f"{kind} DB was built for other elements or precision; run update_kind")
+        lows, highs = self.kind_bounds(kind)
+        conditions = []
+        params = []
+        for e, lo, hi in zip(self.elements, lows.tolist(), highs.tolist()):
+            built_lo, built_hi = manifest["bounds"][e]
+            if lo < built_lo or hi > built_hi:
+                raise ValueError(f"{kind} DB covers {e}[{built_lo},{built_hi}], limits ask for "
+                                 f"{e}[{lo},{hi}]; run update_kind")
+            if lo > built_lo or hi < built_hi:
+                conditions.append(f' AND {table}"{e}" BETWEEN ? AND ?')
+                params.extend([lo, hi])
+        return "".join(conditions), params
+
+
+    def _bounds_mask(self, kind, coeffs):
+        """
+        rows of a packed shard inside the current limits, the array form of bounds_filter
+        """
+
+        lows, highs = self.kind_bounds(kind)
+        return np.all((coeffs >= lows) & (coeffs <= highs), axis = 1)
+
+
+    def _result_array(self, rows, target, ppm_tolerance):
+
+        table = np.array(rows, dtype = np.int64).reshape(len(rows), len(self.elements) + 1)
+        masses, coeffs = table[:, 0], table[:, 1:]
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            ppm_errors = (masses - target) / target * 1e6
+        keep = np.abs(ppm_errors) <= ppm_tolerance
+        masses, coeffs, ppm_errors = masses[keep], coeffs[keep], ppm_errors[keep]
+        order = np.lexsort(coeffs.T[::-1]) if len(coeffs) else np.zeros(0, dtype = np.int64)
+
+        results = np.zeros(len(order), dtype = result_dtype(self.elements))
+        for i, e in enumerate(self.elements):
+            results[e] = coeffs[order, i]
+        results["ppm_error"] = ppm_errors[order]
+        results["delta_mass"] = (masses[order] - target) / self.scale
+        return results
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# mzDB build / verify benchmark
+#
+# Builds (or brings up to date) an mzDB, times construction per kind, times query
+# throughput at several batch sizes, and verifies every kind: manifest current,
+# shard checksums and row counts, and a random sample of answers cross-checked
+# against delta_solver.find_delta_formulas. Exits 1 when any check fails, so it can
+# gate a production batch.
+#
+#   python mzDB_bench.py --db mzdb                     # update if needed, time, verify
+#   python mzDB_bench.py --db mzdb --verify-only       # integrity check only
+#   python mzDB_bench.py --db /tmp/b --rebuild --limits "C[0,12], H[0,24], N[0,3], O[0,6]" --out bench.tsv
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+import delta_solver
+from delta_bench import ELEMENT_MASSES
+from mzDB import mzDB, STORAGES
+
+DEFAULT_LIMITS = "C[0,10], H[0,20], N[0,3], O[0,5], S[0,1]"
+BATCH_SIZES = [1, 10, 100, 1000]
+COLUMNS = ["kind", "step", "batch", "seconds", "per_s", "rows", "detail"]
+
+
+# Masses of random compositions of the kind's lattice, jittered within half the tolerance
+def sample_masses(db, kind, count, ppm, rng):
+    lows, highs = db.kind_bounds(kind)
+    masses = []
+    while len(masses) < count:
+        coeffs = np.array([rng.randint(int(lo), int(hi)) for lo, hi in zip(lows, highs)], dtype=np.int64)
+        mass = int(coeffs @ db.mass_i) / db.scale
+        if mass != 0:
+            masses.append(mass * (1 + rng.uniform(-0.5, 0.5) * ppm / 1e6))
+    return np.array(masses)
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def build(db, kind, rebuild):
+    t0 = time.perf_counter()
+    manifest = db.build_kind(kind) if rebuild else db.update_kind(kind)
+    elapsed = time.perf_counter() - t0
+    rows = sum(shard["rows"] for shard in manifest["shards"].values())
+    return {"kind": kind, "step": "build", "batch": "", "seconds": elapsed,
+            "per_s": rows / elapsed if elapsed > 0 else float("inf"), "rows": rows,
+            "detail": "{} shards, {:.1f} MB".format(len(manifest["shards"]), directory_size(db.kind_dir(kind)) / 2 ** 20)}
+
+
+def time_queries(db, kind, masses, ppm, batch):
+    t0 = time.perf_counter()
+    matches = 0
+    if batch == 1:
+        for mass in masses:
+            matches += len(db.query(mass, ppm, kind))
+    else:
+        for start in range(0, len(masses), batch):
+            offsets, _, _ = db.query_many(masses[start:start + batch], ppm, kind)
+            matches += int(offsets[-1])
+    elapsed = time.perf_counter() - t0
+    return {"kind": kind, "step": "query", "batch": batch, "seconds": elapsed,
+            "per_s": len(masses) / elapsed if elapsed > 0 else float("inf"), "rows": matches, "detail": ""}
+
+
+def verify(db, kind, sample, ppm, seed):
+    t0 = time.perf_counter()
+    report = db.verify(kind, sample=sample, ppm_tolerance=ppm, seed=seed)
+    return {"kind": kind, "step": "verify", "batch": "", "seconds": time.perf_counter() - t0,
+            "per_s": float("nan"), "rows": report["rows"],
+            "detail": "; ".join(report["problems"]) or "ok ({} shards, {} sampled)".format(report["shards"],
+                                                                                        report["sampled"])}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build, benchmark and verify an mzDB")
+    parser.add_argument("--db", required=True, help="mzDB directory")
+    parser.add_argument("--elements", help="elements TSV (Symbol, mz); defaults to the notebook masses")
+    parser.add_argument("--limits", default=DEFAULT_LIMITS, help="element limits, e.g. \"C[0,10], H[0,20]\"")
+    parser.add_argument("--kinds", default="fragment,delta")
+    parser.add_argument("--shard-width", type=float, default=50.0)
+    parser.add_argument("--max-mass", type=float)
+    parser.add_argument("--storage", default="packed", choices=STORAGES)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--batch-sizes", default=",".join(str(b) for b in BATCH_SIZES))
+    parser.add_argument("--queries", type=int, default=2000, help="masses timed per batch size")
+    parser.add_argument("--ppm", type=float, default=5.0)
+    parser.add_argument("--sample", type=int, default=100, help="answers cross-checked per kind")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rebuild", action="store_true", help="build from scratch instead of updating")
+    parser.add_argument("--verify-only", action="store_true", help="skip building and timing")
+    parser.add_argument("--out", help="write the result table as TSV instead of stdout")
+    args = parser.parse_args(argv)
+
+    element_masses = delta_solver.load_element_masses(args.elements) if args.elements else ELEMENT_MASSES
+    limits = delta_solver.parse_bounds(args.limits)
+    db = mzDB(args.db, element_masses, {e: limits[e] for e in limits if e in element_masses},
+              shard_width=args.shard_width, max_mass=args.max_mass, jobs=args.jobs, storage=args.storage)
+
+    rows = []
+    for kind in args.kinds.split(","):
+        if not args.verify_only:
+            rows.append(build(db, kind, args.rebuild))
+            masses = sample_masses(db, kind, args.queries, args.ppm, random.Random(args.seed))
+            for batch in (int(b) for b in args.batch_sizes.split(",")):
+                rows.append(time_queries(db, kind, masses, args.ppm, batch))
+        rows.append(verify(db, kind, args.sample, args.ppm, args.seed))
+        print("{kind}\t{step}\t{detail}".format(**rows[-1]), file=sys.stderr)
+    db.close()
+
+    out = open(args.out, "w") if args.out else sys.stdout
+    out.write("\t".join(COLUMNS) + "\n")
+    for row in rows:
+        out.write("\t".join(
+            "{:.4g}".format(row[c]) if isinstance(row[c], float) else str(row[c]) for c in COLUMNS) + "\n")
+    if args.out:
+        out.close()
+    return 1 if any(row["step"] == "verify" and not row["detail"].startswith("ok") for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,36 +1,133 @@
 import itertools
 import numpy as np
-from collections import defaultdict
+from delta_solver import CHUNK_SIZE, _coeff_dtype, iter_lattice_chunks
 
-def build_delta_dict(element_masses, element_limits, precision_limit):
+def iter_delta_chunks(element_masses, element_limits, precision_limit, chunk_size = CHUNK_SIZE,
+                      integer = False):
+    """
+    Stream the lattice of element count changes in blocks of at most chunk_size rows,
+    yielding (masses, compositions) per block. Rows are decoded from their flat index
+    with mixed-radix arithmetic, so peak memory is set by chunk_size rather than the
+    full product of the element ranges. With integer=True masses are int64 fixed-point
+    values scaled by 10 ** precision_limit.
+    """
+
+    #get possible deltas for each element, in element_masses order
+    if integer:
+        masses = np.array([round(mass * 10 ** precision_limit) for mass in element_masses.values()],
+                          dtype = np.int64)
+    else:
+        masses = np.array([round(mass, precision_limit) for mass in element_masses.values()])
+    lows = [element_limits[element][0] for element in element_masses]
+    highs = [element_limits[element][1] for element in element_masses]
+    dtype = _coeff_dtype(lows, highs)
+
+    for element_deltas in iter_lattice_chunks(lows, highs, chunk_size):
+
+        #get mass of each combination
+        yield element_deltas @ masses, element_deltas.astype(dtype)
+
+class DeltaTable:
+    """
+    Delta dictionary stored as flat arrays: sorted unique int64 mass keys (fixed point,
+    scaled by 10 ** precision_limit like SCALE in delta_solver), an offsets array and
+    one contiguous composition matrix. Compositions for keys[i] are the rows
+    offsets[i]:offsets[i + 1]. Lookups are binary searches on the keys.
+    """
+
+    def __init__(self, elements, keys, offsets, compositions, precision_limit):
+
+        self.elements = list(elements)
+        self.keys = keys
+        self.offsets = offsets
+        self.compositions = compositions
+        self.precision_limit = precision_limit
+        self.scale = 10 ** precision_limit
+
+    def _key(self, mass):
+
+        return int(round(mass * self.scale))
+
+    def __len__(self):
+
+        return len(self.keys)
+
+    def __contains__(self, mass):
+
+        i = np.searchsorted(self.keys, self._key(mass))
+        return i < len(self.keys) and self.keys[i] == self._key(mass)
+
+    def __getitem__(self, mass):
+
+        rows = self.get(mass)
+        if rows is None:
+            raise KeyError(mass)
+        return rows
+
+    def masses(self):
+
+        return self.keys / self.scale
+
+    def keys_range(self, mass, tol = 0):
+        """
+        index range [start, stop) of keys within tol of mass
+        """
+
+        start = np.searchsorted(self.keys, self._key(mass - tol), side = "left")
+        stop = np.searchsorted(self.keys, self._key(mass + tol), side = "right")
+        return int(start), int(stop)
+
+    def get(self, mass, tol = 0, default = None):
+        """
+        compositions (rows in self.elements order) of every key within tol of mass,
+        as one contiguous view of the composition matrix, or default if there are none
+        """
+
+        start, stop = self.keys_range(mass, tol)
+        if start == stop:
+            return default
+        return self.compositions[self.offsets[start]:self.offsets[stop]]
+
+    def items(self):
+
+        for i, key in enumerate(self.keys):
+            yield key / self.scale, self.compositions[self.offsets[i]:self.offsets[i + 1]]
+
+def build_delta_dict(element_masses, element_limits, precision_limit,
+                     min_delta = None, max_delta = None, chunk_size = CHUNK_SIZE):
+    """
+    build the DeltaTable of every composition within element_limits, optionally
+    keeping only deltas strictly inside (min_delta, max_delta)
+    """
+
+    scale = 10 ** precision_limit
+    key_blocks = list()
+    composition_blocks = list()
+    for delta_keys, element_deltas in iter_delta_chunks(element_masses, element_limits,
+                                                        precision_limit, chunk_size, integer = True):
+
+        keep = np.ones(len(delta_keys), dtype = bool)
+        if min_delta is not None:
+            keep &= delta_keys > min_delta * scale
+        if max_delta is not None:
+            keep &= delta_keys < max_delta * scale
 
-    #get possible deltas for each element
-    masses = np.zeros(len(element_masses))
+        key_blocks.append(delta_keys[keep])
+        composition_blocks.append(element_deltas[keep])
 
-    #build delta list in order
-    element_deltas = list()
-    i = 0
-    for element, mass in element_masses.items():
+    lows = [element_limits[element][0] for element in element_masses]
+    highs = [element_limits[element][1] for element in element_masses]
+    delta_keys = np.concatenate(key_blocks) if key_blocks else np.zeros(0, dtype = np.int64)
+    element_deltas = (np.concatenate(composition_blocks) if composition_blocks
+                      else np.zeros((0, len(element_masses)), dtype = _coeff_dtype(lows, highs)))
 
-        #add the mz for this element
-        masses[i] = round(mass, precision_limit)
+    #sort by mass and collapse equal keys into offset ranges
+    order = np.argsort(delta_keys, kind = "stable")
+    keys, counts = np.unique(delta_keys[order], return_counts = True)
+    offsets = np.zeros(len(keys) + 1, dtype = np.int64)
+    np.cumsum(counts, out = offsets[1:])
 
-        #get an array of all possible element count changes
-        element_deltas.append(list(range(element_limits[element][0], element_limits[element][1] + 1)))
-
-    #get all possible combinations of individual element count changes
-    element_deltas = np.array(list(itertools.product(*element_deltas)))
-
-    #get mass of each combination
-    delta_masses = element_deltas @ masses
-
-    #create mapping of delta value to possible compositions
-    delta_dict = defaultdict(list)
-    for delta, element_composition in zip(delta_masses, element_deltas):
-
-        delta_dict[delta].append(element_composition)
-
-    return delta_dict
+    return DeltaTable(element_masses.keys(), keys, offsets, element_deltas[order], precision_limit)
 
 
 
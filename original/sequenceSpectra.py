@@ -28,7 +28,7 @@ def main(config_path):
     #if necessary, create the DBs for sequencer that we can reference
     if config.create_dbs:
 
-        mz_db = mzDB()
+        mz_db = mzDB(config.db_path, config.elements, config.element_limits, jobs = config.jobs)
 
         #create non-negative coefficient dictionaries
         mz_db.create_non_negative_dbs()